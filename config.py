@@ -8,3 +8,54 @@ WEB_SERVICE_BASE_URL = "https://weather-ingestion.onrender.com"
 
 # Database settings
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 4000))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 30))  # Connections kept open per worker
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))  # Additional connections beyond DB_POOL_SIZE
+
+# HTTP caching and compression
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", 60))  # Seconds a client or CDN may reuse a GET response
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))  # Smaller bodies are sent uncompressed
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+
+# Snapshot serving: when set, active batches are exported to memory-mapped files in this directory
+# and the API serves /weather/data and /weather/summarize from them instead of the database.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+# SQL profiling
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))  # Statements slower than this are logged
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", 0))  # Fraction of slow SELECTs logged with EXPLAIN ANALYZE
+QUERY_STATS_MAX_ENTRIES = int(os.getenv("QUERY_STATS_MAX_ENTRIES", 500))  # Statements kept, least recently run dropped first
+# GET /stats/queries exposes raw SQL, so it is only served when enabled, e.g. on an internal deployment
+QUERY_STATS_ENDPOINT = os.getenv("QUERY_STATS_ENDPOINT", "false").lower() == "true"
+
+# Delta ingestion: store only the points that changed versus the previous active batch
+DELTA_INGESTION = os.getenv("DELTA_INGESTION", "false").lower() == "true"
+DELTA_MAX_CHANGED_RATIO = float(os.getenv("DELTA_MAX_CHANGED_RATIO", 0.5))  # Above this the batch is stored in full
+
+# Ingestion
+INGESTION_INTERVAL_SECONDS = int(os.getenv("INGESTION_INTERVAL_SECONDS", 300))  # Pause between ingestion cycles
+
+# Admission control, per worker. The budgets together must stay within DB_POOL_SIZE + DB_MAX_OVERFLOW (50).
+ADMISSION_WEATHER_DATA_CONCURRENCY = int(os.getenv("ADMISSION_WEATHER_DATA_CONCURRENCY", 16))
+ADMISSION_SUMMARIZE_CONCURRENCY = int(os.getenv("ADMISSION_SUMMARIZE_CONCURRENCY", 8))
+ADMISSION_BATCHES_CONCURRENCY = int(os.getenv("ADMISSION_BATCHES_CONCURRENCY", 4))
+ADMISSION_TILES_CONCURRENCY = int(os.getenv("ADMISSION_TILES_CONCURRENCY", 8))
+ADMISSION_CHANGES_CONCURRENCY = int(os.getenv("ADMISSION_CHANGES_CONCURRENCY", 4))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 16))  # Requests allowed to wait per budget
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 0.5))  # Seconds a request may wait for a slot
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))  # Seconds, sent in Retry-After with 503
+
+# Distributed ingestion work queue
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", 60))  # A task whose lease expires is claimed again
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", 5))  # After this many claims the task and its batch fail
+TASK_POLL_INTERVAL_SECONDS = float(os.getenv("TASK_POLL_INTERVAL_SECONDS", 2))  # Idle worker wait between claims
+
+# Map tiles and rasters
+TILE_SIZE = int(os.getenv("TILE_SIZE", 256))  # Width and height of a tile in pixels
+RASTER_MAX_SIZE = int(os.getenv("RASTER_MAX_SIZE", 1024))  # Largest width or height of a bbox raster
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", 256))  # Encoded tiles kept per worker
+# Grid cells fetched around a raster's bbox, so pixels near its edges find their nearest grid point
+RASTER_GRID_PADDING_CELLS = float(os.getenv("RASTER_GRID_PADDING_CELLS", 1.0))
+RASTER_GRID_STEP = float(os.getenv("RASTER_GRID_STEP", 1.0))  # Degrees assumed until a batch's grid step is measured
+
+# Percentile sketches: fixed-bin histograms per batch, metric and lat/lon cell of this size
+SKETCH_CELL_DEGREES = float(os.getenv("SKETCH_CELL_DEGREES", 1.0))
@@ -0,0 +1,139 @@
+import logging
+import threading
+from functools import wraps
+
+from flask import jsonify
+
+from config import (ADMISSION_BATCHES_CONCURRENCY, ADMISSION_CHANGES_CONCURRENCY, ADMISSION_QUEUE_SIZE,
+                    ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER, ADMISSION_SUMMARIZE_CONCURRENCY,
+                    ADMISSION_TILES_CONCURRENCY, ADMISSION_WEATHER_DATA_CONCURRENCY, DB_MAX_OVERFLOW, DB_POOL_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Bounds the requests of one budget running at once in this worker.
+    Requests over the limit wait in a short bounded queue and are shed when it is full or the wait times out.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.shed_queue_full_total = 0
+        self.shed_timeout_total = 0
+
+    def acquire(self) -> bool:
+        """Admit the request, waiting up to queue_timeout for a slot. Returns False if it is shed."""
+        with self._condition:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                self.admitted_total += 1
+                return True
+
+            if self.queued >= self.max_queue:
+                self.shed_queue_full_total += 1
+                return False
+
+            self.queued += 1
+            self.queued_total += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self.in_flight < self.max_in_flight, self.queue_timeout)
+            finally:
+                self.queued -= 1
+
+            if not admitted:
+                self.shed_timeout_total += 1
+                return False
+            self.in_flight += 1
+            self.admitted_total += 1
+            return True
+
+    def release(self) -> None:
+        """Free the slot and wake up one queued request."""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """Current load and counters, for autoscaling decisions."""
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "admitted_total": self.admitted_total,
+                "queued_total": self.queued_total,
+                "shed_queue_full_total": self.shed_queue_full_total,
+                "shed_timeout_total": self.shed_timeout_total,
+            }
+
+
+# Separate budgets so a burst on one endpoint can't starve the others. Together they stay below
+# the connection pool size, so admitted requests don't wait on pool_timeout.
+budgets = {
+    "weather_data": AdmissionController(
+        "weather_data", ADMISSION_WEATHER_DATA_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+    "summarize": AdmissionController(
+        "summarize", ADMISSION_SUMMARIZE_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+    "batches": AdmissionController(
+        "batches", ADMISSION_BATCHES_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+    "tiles": AdmissionController(
+        "tiles", ADMISSION_TILES_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+    "changes": AdmissionController(
+        "changes", ADMISSION_CHANGES_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+    ),
+}
+
+
+def check_pool_capacity() -> bool:
+    """
+    Check that the budgets together fit in the connection pool. Each admitted request holds at most one
+    connection, so otherwise admitted requests can still wait on pool_timeout. Logs a warning if they don't fit.
+    """
+    total = sum(controller.max_in_flight for controller in budgets.values())
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    if total > capacity:
+        logger.warning(f"Admission budgets admit {total} requests at once, more than the {capacity} pooled connections.")
+        return False
+    return True
+
+
+def admit(budget: str):
+    """
+    Decorator running a view under an admission budget, failing fast with 503 and Retry-After when saturated.
+    """
+    controller = budgets[budget]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not controller.acquire():
+                logger.warning(f"Shedding request on budget {budget}: {controller.in_flight} in flight, {controller.queued} queued.")
+                response = jsonify({"error": "Server is overloaded, retry later"})
+                response.status_code = 503
+                response.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+                return response
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release()
+        return wrapper
+    return decorator
+
+
+def admission_stats():
+    """Stats of every budget in this worker."""
+    return {name: controller.stats() for name, controller in budgets.items()}
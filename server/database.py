@@ -1,46 +1,168 @@
 import os
 import logging
+import threading
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from config import DB_MAX_OVERFLOW, DB_POOL_SIZE
+from server.profiling import instrument_engine
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+Base = declarative_base()
 
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is not set")
+# Bump when the models change. Existing databases are brought up to date with SCHEMA_MIGRATIONS,
+# since create_all only creates missing tables and never alters existing ones.
+SCHEMA_VERSION = 6
+# Index builds on large tables, run before SCHEMA_MIGRATIONS outside of a transaction so they don't lock
+# out readers and ingestion. Each step must be safe to repeat after an interrupted build.
+SCHEMA_CONCURRENT_MIGRATIONS = {
+    # Covering index for index-only weather reads, built next to the old index and swapped in
+    2: [
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_weather_lat_lon_time_covering",
+        "CREATE INDEX CONCURRENTLY ix_weather_lat_lon_time_covering ON weather_data (latitude, longitude, forecast_time) "
+        "INCLUDE (batch_id, temperature, precipitation_rate, humidity)",
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_weather_lat_lon_time",
+        "ALTER INDEX ix_weather_lat_lon_time_covering RENAME TO ix_weather_lat_lon_time",
+    ],
+}
+SCHEMA_MIGRATIONS = {
+    # Covering index, see SCHEMA_CONCURRENT_MIGRATIONS
+    2: [],
+    # Content hashes, aliases and delta batches
+    3: [
+        "ALTER TABLE batch_metadata ADD COLUMN IF NOT EXISTS content_hash VARCHAR",
+        "ALTER TABLE batch_metadata ADD COLUMN IF NOT EXISTS page_hashes JSON",
+        "ALTER TABLE batch_metadata ADD COLUMN IF NOT EXISTS alias_of VARCHAR",
+        "ALTER TABLE batch_metadata ADD COLUMN IF NOT EXISTS delta_base VARCHAR",
+        "CREATE INDEX IF NOT EXISTS ix_batch_content_hash ON batch_metadata (content_hash)",
+    ],
+    # ingest_tasks work queue, a new table created by create_all
+    4: [],
+    # weather_sketches, a new table created by create_all. Sketches of active batches are built by the ingestion cleanup.
+    5: [],
+    # forecast_diffs, a new table created by create_all. Diffs of active batches are built by the ingestion cleanup.
+    6: [],
+}
+# Serializes schema setup between workers starting at the same time
+SCHEMA_LOCK_KEY = 7201
+
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+
+def get_engine():
+    """
+    Create the engine on first use, so importing this module has no side effects.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                # Load environment variables from .env file
+                load_dotenv()
+                database_url = os.getenv("DATABASE_URL")
+                if not database_url:
+                    raise ValueError("DATABASE_URL environment variable is not set")
+
+                engine = create_engine(
+                    database_url,
+                    pool_size=DB_POOL_SIZE,          # Base connections to keep open
+                    max_overflow=DB_MAX_OVERFLOW,    # Additional connections beyond pool_size
+                    pool_timeout=40,       # Timeout for acquiring a connection
+                    pool_recycle=28000,    # Recycle connections slightly before server timeout
+                    pool_pre_ping=True,    # Check if the connection is alive before using
+                )
+                instrument_engine(engine)
+                _engine = engine
+    return _engine
+
+
+def SessionLocal():
+    """
+    Create a session bound to the lazily created engine.
+    """
+    return _session_factory(bind=get_engine())
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=30,          # Base connections to keep open
-    max_overflow=20,       # Additional connections beyond pool_size
-    pool_timeout=40,       # Timeout for acquiring a connection
-    pool_recycle=28000,    # Recycle connections slightly before server timeout
-    pool_pre_ping=True,    # Check if the connection is alive before using
-)
-Base = declarative_base()
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+def _stored_schema_version(conn):
+    """
+    Read the schema version, None for an empty database. A database created before
+    versioning has tables but no schema_version table, and counts as version 1.
+    """
+    if conn.execute(text("SELECT to_regclass('schema_version') IS NOT NULL")).scalar():
+        return conn.execute(text("SELECT max(version) FROM schema_version")).scalar()
+    if conn.execute(text("SELECT to_regclass('weather_data') IS NOT NULL")).scalar():
+        return 1
+    return None
+
+
+def _schema_is_current(stored_version) -> bool:
+    """
+    Check whether the schema needs no changes. A newer schema, e.g. written by new workers during a rolling
+    deploy, is left alone: downgrading the version would make the next new worker run every migration again.
+    """
+    if stored_version is None or stored_version < SCHEMA_VERSION:
+        return False
+    if stored_version > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {stored_version} is newer than this code's version {SCHEMA_VERSION}. Leaving it unchanged.")
+    else:
+        logger.info(f"Database schema is up to date (version {SCHEMA_VERSION}).")
+    return True
+
+
+def _migrate(lock_conn, stored_version) -> None:
+    """
+    Bring the schema from the stored version to SCHEMA_VERSION. The concurrent index builds run first on the
+    autocommit lock connection, then the tables, migrations and version are written in one transaction.
+    """
+    from server.models import SchemaVersion
+    if stored_version is not None:
+        for version in range(stored_version + 1, SCHEMA_VERSION + 1):
+            for statement in SCHEMA_CONCURRENT_MIGRATIONS.get(version, []):
+                lock_conn.execute(text(statement))
+
+    with get_engine().begin() as conn:
+        Base.metadata.create_all(bind=conn)
+        if stored_version is not None:
+            for version in range(stored_version + 1, SCHEMA_VERSION + 1):
+                for statement in SCHEMA_MIGRATIONS.get(version, []):
+                    conn.execute(text(statement))
+        conn.execute(SchemaVersion.__table__.delete())
+        conn.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
 
 
 # Function to initialize the database
 def init_db():
-    from server.models import BatchMetadata, WeatherData
+    from server.models import BatchMetadata, SchemaVersion, WeatherData
     try:
-        Base.metadata.create_all(bind=engine)
-        logger.info("Tables created successfully!")
+        with get_engine().connect() as lock_conn:
+            # CREATE INDEX CONCURRENTLY can't run in a transaction, so the migration is serialized with a
+            # session-level lock held on an autocommit connection.
+            lock_conn = lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+            stored_version = _stored_schema_version(lock_conn)
+            if _schema_is_current(stored_version):
+                return
+
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            try:
+                stored_version = _stored_schema_version(lock_conn)
+                if _schema_is_current(stored_version):
+                    return
+                _migrate(lock_conn, stored_version)
+            finally:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        logger.info(f"Database schema updated from version {stored_version} to {SCHEMA_VERSION}.")
     except Exception as e:
         logger.error(f"Error creating tables: {e}")
     logger.info("Database initialization complete!")
 
-    
-    
+
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # Run from the imported module: under `python -m` this file is __main__, whose Base has no models registered.
+    from server.database import init_db
     init_db()
@@ -0,0 +1,94 @@
+import heapq
+from typing import Dict, Iterable, List, Mapping
+
+import numpy as np
+
+from server.snapshots import METRICS
+
+# Number of points returned by a top changes ranking, by default and at most
+DEFAULT_TOP_CHANGES = 10
+MAX_TOP_CHANGES = 1000
+
+
+def join_points(latitudes, longitudes, previous_latitudes, previous_longitudes) -> np.ndarray:
+    """
+    Join two sets of points on (latitude, longitude): the index of each point in the previous set, or -1.
+    Both sets are numbered together with np.unique, without a Python loop over points.
+    """
+    points = np.stack([
+        np.concatenate([latitudes, previous_latitudes]),
+        np.concatenate([longitudes, previous_longitudes]),
+    ], axis=1)
+    _, point_ids = np.unique(points, axis=0, return_inverse=True)
+    point_ids = point_ids.reshape(-1)
+    current_ids, previous_ids = point_ids[:len(latitudes)], point_ids[len(latitudes):]
+
+    positions = np.full(len(points), -1, dtype=np.int64)
+    positions[previous_ids] = np.arange(len(previous_ids))
+    return positions[current_ids]
+
+
+def _columns(records: List[Mapping]) -> Dict[str, np.ndarray]:
+    """The coordinates and metrics of records as float arrays, NaN for missing values."""
+    return {
+        column: np.array([record.get(column) for record in records], dtype=np.float64)
+        for column in ("latitude", "longitude", *METRICS)
+    }
+
+
+def build_forecast_diffs(batch_id: str, previous_batch_id: str, records: List[Mapping], previous_records: List[Mapping]) -> List[Dict]:
+    """
+    Build the forecast_diffs rows of a batch against the previous active batch: the change of every metric
+    at each point present in both. A change is None when either value is missing.
+    """
+    if not records or not previous_records:
+        return []
+    current, previous = _columns(records), _columns(previous_records)
+    matches = join_points(current["latitude"], current["longitude"], previous["latitude"], previous["longitude"])
+    # A point repeated in the batch is diffed once, from its first record
+    _, first = np.unique(np.stack([current["latitude"], current["longitude"]], axis=1), axis=0, return_index=True)
+    matched = np.zeros(len(records), dtype=bool)
+    matched[first] = True
+    matched &= matches >= 0
+
+    columns = {
+        "latitude": current["latitude"][matched],
+        "longitude": current["longitude"][matched],
+    }
+    for metric in METRICS:
+        columns[metric] = current[metric][matched] - previous[metric][matches[matched]]
+
+    values = [[None if np.isnan(v) else float(v) for v in array] for array in columns.values()]
+    return [
+        {"batch_id": batch_id, "previous_batch_id": previous_batch_id, **dict(zip(columns, point))}
+        for point in zip(*values)
+    ]
+
+
+def top_changes(rows: Iterable, limit: int) -> List:
+    """
+    The rows with the largest absolute change, largest first, keeping only `limit` rows in memory while
+    consuming the iterable. Rows are (latitude, longitude, change) tuples with a non-null change.
+    """
+    return heapq.nlargest(limit, rows, key=lambda row: abs(row.change))
+
+
+def format_point_changes(rows) -> List[Dict]:
+    """Format the changes at a point, one entry per pair of consecutive active batches."""
+    return [{
+        "batch_id": row.batch_id,
+        "forecast_time": row.forecast_time,
+        "previous_batch_id": row.previous_batch_id,
+        "previous_forecast_time": row.previous_forecast_time,
+        "changes": {metric: getattr(row, metric) for metric in METRICS},
+    } for row in rows]
+
+
+def format_top_changes(batch_id: str, previous_batch_id: str, metric: str, rows) -> Dict:
+    """Format a ranking of the biggest changes of a metric, largest absolute change first."""
+    return {
+        "batch_id": batch_id,
+        "previous_batch_id": previous_batch_id,
+        "metric": metric,
+        "changes": [{"latitude": row.latitude, "longitude": row.longitude, "change": row.change} for row in rows],
+    }
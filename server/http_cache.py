@@ -0,0 +1,142 @@
+import gzip
+import logging
+from functools import wraps
+
+from flask import make_response, request
+
+from config import CACHE_MAX_AGE, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE
+from server.snapshots import snapshot_store, snapshots_enabled
+from server.utils import fetch_data_generation
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/octet-stream"}
+
+
+def _content_coding():
+    """The content coding compress_response uses for the request: brotli, else gzip, as accepted by the client."""
+    accept_encodings = request.accept_encodings
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def _matching_etag(etag):
+    """
+    The tag of the request's If-None-Match matching the generation, or None.
+    A compressed variant's tag carries its content-coding suffix, which must be the coding the client
+    would be sent now. The matched tag is echoed as is, since only the 200 knew whether the body was compressed.
+    With `*` no tag was sent, and the bare generation tag is returned.
+    """
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return etag
+    coding = _content_coding()
+    variants = {etag, f"{etag}-{coding}"} if coding else {etag}
+    return next((tag for tag in if_none_match if tag in variants), None)
+
+
+def _not_modified_etag(etag, last_modified):
+    """
+    Evaluate the conditional request headers, returning the ETag to send with a 304 or None if the client's
+    representation is stale. If-None-Match takes precedence over If-Modified-Since, which gets the bare tag:
+    without a tag from the client there is no knowing which variant it holds.
+    """
+    if request.if_none_match:
+        return _matching_etag(etag)
+    if request.if_modified_since and last_modified is not None:
+        if last_modified.replace(microsecond=0) <= request.if_modified_since:
+            return etag
+    return None
+
+
+def _generation(from_snapshots: bool):
+    """
+    The validators of the data a view serves. Views answered from snapshots are validated against the loaded
+    snapshot manifest, without a database round trip, so the tag only changes when the served data does.
+    """
+    if from_snapshots and snapshots_enabled():
+        generation = snapshot_store.generation()
+        if generation is not None:
+            return generation
+    return fetch_data_generation()
+
+
+def conditional(view=None, *, snapshots=False):
+    """
+    Serve a GET view conditionally on the data generation.
+    A client holding the current representation gets 304 before the view queries the weather tables.
+    Set `snapshots` (or a callable deciding per request) for views answered from the published snapshots.
+    """
+    if view is None:
+        return lambda view: conditional(view, snapshots=snapshots)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            etag, last_modified = _generation(snapshots() if callable(snapshots) else snapshots)
+        except Exception as e:
+            logger.error(f"Serving without validators, data generation unavailable: {e}")
+            return view(*args, **kwargs)
+
+        not_modified_etag = _not_modified_etag(etag, last_modified)
+        if not_modified_etag is not None:
+            # compress_response leaves a 304 alone, so it gets the tag the 200 carried
+            response = make_response("", 304)
+            response.set_etag(not_modified_etag)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.set_etag(etag)
+
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        response.vary.add("Accept-Encoding")
+        return response
+
+    return wrapper
+
+
+def compress_response(response):
+    """
+    Compress large JSON/binary bodies with brotli or gzip, as accepted by the client.
+    """
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = _content_coding()
+    if encoding == "br":
+        body = brotli.compress(data)
+    elif encoding == "gzip":
+        body = gzip.compress(data, compresslevel=COMPRESSION_LEVEL)
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+
+    # A strong ETag must differ between content codings of the same resource.
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
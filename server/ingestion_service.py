@@ -1,19 +1,28 @@
+import argparse
 import asyncio
+import hashlib
+import json
 import logging
 import time
 from datetime import datetime
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 import httpx
 from dateutil.parser import isoparse
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from sqlalchemy import TIMESTAMP, and_, exists, insert, literal, or_, select
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased
+
+from server.database import SessionLocal, init_db
+from server.forecast_diffs import build_forecast_diffs
+from server.models import BatchMetadata, ForecastDiff, IngestTask, WeatherData, WeatherSketch
+from server.profiling import stage
+from server.sketches import build_batch_sketches
+from server.snapshots import export_snapshot, has_snapshot, publish_snapshots, snapshots_enabled
+from server.utils import fetch_batch_records, utc_timestamp
+from config import (BATCHES_ENDPOINT, BATCH_DATA_ENDPOINT, BATCH_SIZE, DELTA_INGESTION, DELTA_MAX_CHANGED_RATIO,
+                    INGESTION_INTERVAL_SECONDS)
 
-from server.database import SessionLocal
-from server.models import BatchMetadata, WeatherData
-from config import BATCHES_ENDPOINT, BATCH_DATA_ENDPOINT, BATCH_SIZE
-
-# Logging setup
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
@@ -33,24 +42,101 @@ async def fetch_batches() -> List[Dict[str, str]]:
             return []
 
 @retry(stop=stop_after_attempt(5), wait=wait_exponential(min=2, max=10), retry=retry_if_exception_type(httpx.RequestError))
-async def fetch_batch_data(batch_id: str, total_pages: int = 5) -> List[Dict[str, Union[str, float]]]:
-    """Fetch paginated batch data from the external API."""
+async def fetch_batch_pages(batch_id: str, total_pages: int = 5) -> List[List[Dict[str, Union[str, float]]]]:
+    """Fetch paginated batch data from the external API, keeping the records of each page together."""
 
     async with httpx.AsyncClient() as client:
         try:
             tasks = [client.get(BATCH_DATA_ENDPOINT.format(batch_id=batch_id), params={"page": page}) for page in range(total_pages)]
             responses = await asyncio.gather(*tasks)
-            batch_data = []
+            batch_pages = []
             for response in responses:
                 if response.status_code == 200:
                     json_data = response.json()
-                    batch_data.extend(json_data.get("data", []))
-            logger.info(f"Fetched {len(batch_data)} records for batch {batch_id}.")
-            return batch_data
+                    batch_pages.append(json_data.get("data", []))
+            logger.info(f"Fetched {sum(len(page) for page in batch_pages)} records for batch {batch_id}.")
+            return batch_pages
         except httpx.RequestError as e:
             logger.error(f"Error fetching batch data for {batch_id}: {e}")
             return []
 
+async def fetch_batch_data(batch_id: str, total_pages: int = 5) -> List[Dict[str, Union[str, float]]]:
+    """Fetch paginated batch data from the external API."""
+    batch_pages = await fetch_batch_pages(batch_id, total_pages)
+    return [record for page in batch_pages for record in page]
+
+def hash_page(records: List[Dict[str, Union[str, float]]]) -> str:
+    """Hash a page's records in canonical JSON form, independent of key order and formatting."""
+    return hashlib.sha256(json.dumps(records, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def hash_batch(page_hashes: List[str]) -> str:
+    """Hash a batch from its page hashes."""
+    return hashlib.sha256("".join(page_hashes).encode()).hexdigest()
+
+def release_batch_rows(session, batch: BatchMetadata) -> bool:
+    """
+    Make a retiring batch's rows independent of the batches that still read them.
+    Returns True if the rows were handed over to an active alias and must not be deleted.
+    """
+    heir = session.query(BatchMetadata).filter(
+        BatchMetadata.alias_of == batch.batch_id,
+        BatchMetadata.status == "ACTIVE",
+    ).first()
+    if heir is not None:
+        # The alias has the same records, so it takes over the rows and the deltas built on them.
+        session.query(WeatherData).filter(WeatherData.batch_id == batch.batch_id).update(
+            {WeatherData.batch_id: heir.batch_id}, synchronize_session=False
+        )
+        session.query(WeatherSketch).filter(WeatherSketch.batch_id == batch.batch_id).update(
+            {WeatherSketch.batch_id: heir.batch_id}, synchronize_session=False
+        )
+        session.query(ForecastDiff).filter(ForecastDiff.batch_id == batch.batch_id).update(
+            {ForecastDiff.batch_id: heir.batch_id}, synchronize_session=False
+        )
+        session.query(ForecastDiff).filter(ForecastDiff.previous_batch_id == batch.batch_id).update(
+            {ForecastDiff.previous_batch_id: heir.batch_id}, synchronize_session=False
+        )
+        session.query(BatchMetadata).filter(BatchMetadata.alias_of == batch.batch_id).update(
+            {BatchMetadata.alias_of: heir.batch_id}, synchronize_session=False
+        )
+        session.query(BatchMetadata).filter(BatchMetadata.delta_base == batch.batch_id).update(
+            {BatchMetadata.delta_base: heir.batch_id}, synchronize_session=False
+        )
+        heir.alias_of = None
+        logger.info(f"Handed over rows of batch {batch.batch_id} to its alias {heir.batch_id}.")
+        return True
+
+    deltas = session.query(BatchMetadata).filter(
+        BatchMetadata.delta_base == batch.batch_id,
+        BatchMetadata.status == "ACTIVE",
+    ).all()
+    for delta in deltas:
+        # Copy the base rows the delta does not override, turning it into a full batch.
+        base = aliased(WeatherData)
+        override = aliased(WeatherData)
+        session.execute(insert(WeatherData).from_select(
+            ["batch_id", "latitude", "longitude", "forecast_time", "temperature", "precipitation_rate", "humidity"],
+            select(
+                literal(delta.batch_id),
+                base.latitude,
+                base.longitude,
+                utc_timestamp(literal(delta.forecast_time, TIMESTAMP)),
+                base.temperature,
+                base.precipitation_rate,
+                base.humidity,
+            ).where(
+                base.batch_id == batch.batch_id,
+                ~exists().where(
+                    override.batch_id == delta.batch_id,
+                    override.latitude == base.latitude,
+                    override.longitude == base.longitude,
+                ),
+            ),
+        ))
+        delta.delta_base = None
+        logger.info(f"Materialized delta batch {delta.batch_id} before retiring its base {batch.batch_id}.")
+    return False
+
 def delete_old_active_batches() -> None:
 
     session = SessionLocal()
@@ -62,7 +148,14 @@ def delete_old_active_batches() -> None:
         if len(active_batches) > 3:
             excess_batches = len(active_batches) - 3
             for batch in active_batches[:excess_batches]:
-                session.query(WeatherData).filter(WeatherData.batch_id == batch.batch_id).delete()
+                if not release_batch_rows(session, batch):
+                    session.query(WeatherData).filter(WeatherData.batch_id == batch.batch_id).delete()
+                    session.query(WeatherSketch).filter(WeatherSketch.batch_id == batch.batch_id).delete()
+                    # The next batch's diffs against this one go too: the oldest active batch has no previous batch.
+                    session.query(ForecastDiff).filter(or_(
+                        ForecastDiff.batch_id == batch.batch_id,
+                        ForecastDiff.previous_batch_id == batch.batch_id,
+                    )).delete(synchronize_session=False)
                 batch.status = "INACTIVE"
             session.commit()
             logger.info(f"Deleted {excess_batches} old active batches.")
@@ -95,6 +188,22 @@ def delete_weather_data_for_non_retained_batches() -> None:
     finally:
         session.close()
 
+def delete_finished_tasks() -> None:
+    """Delete the work queue tasks of removed and failed batches, so claims and queue stats don't scan past them."""
+    session = SessionLocal()
+    try:
+        deleted = session.query(IngestTask).filter(IngestTask.batch_id.in_(
+            select(BatchMetadata.batch_id).where(BatchMetadata.status.in_(["INACTIVE", "FAILED"]))
+        )).delete(synchronize_session=False)
+        session.commit()
+        if deleted:
+            logger.info(f"Deleted {deleted} tasks of removed and failed batches.")
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error deleting finished tasks: {e}")
+    finally:
+        session.close()
+
 # Retain metadata for deleted batches
 def retain_metadata_for_deleted_batches() -> None:
 
@@ -120,6 +229,7 @@ def retain_metadata_for_deleted_batches() -> None:
 
 
 @retry(stop=stop_after_attempt(5), wait=wait_exponential(min=2, max=10), retry=retry_if_exception_type(OperationalError))
+@stage("insert")
 def batch_insert_weather_data(weather_records: List[WeatherData]) -> None:
     """Insert weather data into the database in batches."""
     session = SessionLocal()
@@ -154,6 +264,7 @@ async def fetch_total_pages(batch_id: str) -> int:
             logger.error(f"Error fetching total pages for batch {batch_id}: {e}")
             return 1
 
+@stage("metadata")
 async def ingest_batch(batch: Dict[str, Union[str, int]]) -> None:
     """Ingest batch data and update database metadata."""
     session = SessionLocal()
@@ -167,26 +278,228 @@ async def ingest_batch(batch: Dict[str, Union[str, int]]) -> None:
             return
 
         logger.info(f"Starting ingestion for batch {batch_id}.")
-        batch_data, metadata = await initialize_metadata(session, batch_id, batch_forecast_time)
-
-        process_batch_weather_data(batch_id, batch_forecast_time, batch_data)
+        batch_pages, metadata = await initialize_metadata(session, batch_id, batch_forecast_time)
+        batch_data = [record for page in batch_pages for record in page]
+
+        original = find_identical_batch(session, metadata)
+        if original is not None:
+            metadata.alias_of = original.batch_id
+            logger.info(f"Batch {batch_id} is identical to batch {original.batch_id}. Aliasing it without inserting rows.")
+        else:
+            records = batch_data
+            base = find_delta_base(session, metadata) if DELTA_INGESTION else None
+            if base is not None:
+                delta = compute_delta(session, base, batch_pages)
+                if delta is not None:
+                    metadata.delta_base = base.batch_id
+                    records = delta
+                    logger.info(f"Batch {batch_id} changes {len(delta)}/{len(batch_data)} points versus batch {base.batch_id}. Storing the delta only.")
+            process_batch_weather_data(batch_id, batch_forecast_time, records)
+            # Sketches are built from the full batch, also when only a delta is stored.
+            store_batch_sketches(session, batch_id, batch_data)
+            previous = find_previous_batch(session, metadata)
+            if previous is not None:
+                store_forecast_diffs(session, batch_id, previous.batch_id, batch_data)
         update_metadata_status(session, metadata)
         logger.info(f"Batch {batch_id} ingested successfully.")
+        snapshot_batch(batch_id, batch_forecast_time, batch_data, metadata.alias_of)
     except Exception as e:
         session.rollback()
         logger.error(f"Error ingesting batch {batch_id}: {e}")
         metadata = session.query(BatchMetadata).filter_by(batch_id=batch_id).first()
         if metadata:
             metadata.status = "FAILED"
+            # Rows inserted before the failure would be read as a partial batch
+            session.query(WeatherData).filter(WeatherData.batch_id == batch_id).delete()
             session.commit()
     finally:
         session.close()
 
+def find_identical_batch(session, metadata: BatchMetadata) -> Optional[BatchMetadata]:
+    """Find an active batch with the same content and forecast time that stores its rows in full."""
+    if not metadata.number_of_rows:
+        return None
+    return session.query(BatchMetadata).filter(
+        BatchMetadata.content_hash == metadata.content_hash,
+        BatchMetadata.forecast_time == metadata.forecast_time,
+        BatchMetadata.batch_id != metadata.batch_id,
+        BatchMetadata.status == "ACTIVE",
+        BatchMetadata.alias_of.is_(None),
+        BatchMetadata.delta_base.is_(None),
+    ).first()
+
+def find_delta_base(session, metadata: BatchMetadata) -> Optional[BatchMetadata]:
+    """Find the fully stored batch behind the latest active batch, to store a new batch against."""
+    previous = session.query(BatchMetadata).filter(
+        BatchMetadata.status == "ACTIVE",
+        BatchMetadata.batch_id != metadata.batch_id,
+    ).order_by(BatchMetadata.forecast_time.desc()).first()
+    if previous is None:
+        return None
+    base_id = previous.delta_base or previous.alias_of
+    return session.get(BatchMetadata, base_id) if base_id else previous
+
+def compute_delta(session, base: BatchMetadata, batch_pages) -> Optional[List[Dict[str, Union[str, float]]]]:
+    """
+    Return the records that differ from the base batch, or None if the batch must be stored in full
+    because points were added or removed, or too many changed.
+    Pages whose hash matches the base's page at the same position are identical and skipped.
+    """
+    base_rows = fetch_batch_records(session, base.batch_id)
+    base_values = {
+        (row.latitude, row.longitude): (row.temperature, row.precipitation_rate, row.humidity)
+        for row in base_rows
+    }
+    number_of_rows = sum(len(page) for page in batch_pages)
+    if not number_of_rows or number_of_rows != len(base_values):
+        return None
+
+    base_page_hashes = base.page_hashes or []
+    delta = []
+    for page_number, page in enumerate(batch_pages):
+        if page_number < len(base_page_hashes) and hash_page(page) == base_page_hashes[page_number]:
+            continue
+        for record in page:
+            key = (record["latitude"], record["longitude"])
+            if key not in base_values:
+                return None
+            if base_values[key] != (record.get("temperature"), record.get("precipitation_rate"), record.get("humidity")):
+                delta.append(record)
+
+    if len(delta) > DELTA_MAX_CHANGED_RATIO * number_of_rows:
+        return None
+    return delta
+
+@stage("sketch")
+def store_batch_sketches(session, batch_id: str, records: Optional[List[Dict[str, Union[str, float]]]] = None) -> None:
+    """
+    Store the percentile sketches of a batch, built from its full records.
+    Records are read back from the database if not given. Committed by the caller.
+    """
+    if records is None:
+        records = [row._mapping for row in fetch_batch_records(session, batch_id)]
+    rows = build_batch_sketches(batch_id, records)
+    session.bulk_insert_mappings(WeatherSketch, rows)
+    logger.info(f"Built {len(rows)} sketches for batch {batch_id}.")
+
+def build_missing_sketches() -> None:
+    """Build the sketches of active batches stored before sketches existed."""
+    session = SessionLocal()
+    try:
+        batches = session.query(BatchMetadata.batch_id).filter(
+            BatchMetadata.status == "ACTIVE",
+            BatchMetadata.alias_of.is_(None),
+            ~exists().where(WeatherSketch.batch_id == BatchMetadata.batch_id),
+        ).all()
+        for batch in batches:
+            store_batch_sketches(session, batch.batch_id)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error building missing sketches: {e}")
+    finally:
+        session.close()
+
+def find_previous_batch(session, metadata: BatchMetadata) -> Optional[BatchMetadata]:
+    """
+    Find the active batch before this one, ordered by forecast time then batch_id, to diff its forecast against.
+    Aliases are skipped, since they have the same records as their original.
+    """
+    return session.query(BatchMetadata).filter(
+        BatchMetadata.status == "ACTIVE",
+        BatchMetadata.alias_of.is_(None),
+        or_(
+            BatchMetadata.forecast_time < metadata.forecast_time,
+            and_(BatchMetadata.forecast_time == metadata.forecast_time, BatchMetadata.batch_id < metadata.batch_id),
+        ),
+    ).order_by(BatchMetadata.forecast_time.desc(), BatchMetadata.batch_id.desc()).first()
+
+@stage("diff")
+def store_forecast_diffs(session, batch_id: str, previous_batch_id: str,
+                         records: Optional[List[Dict[str, Union[str, float]]]] = None) -> None:
+    """
+    Replace the forecast diffs of a batch with its changes against the previous batch, joined on the points
+    with NumPy. Records are read back from the database if not given. Committed by the caller.
+    """
+    if records is None:
+        records = [row._mapping for row in fetch_batch_records(session, batch_id)]
+    previous_records = [row._mapping for row in fetch_batch_records(session, previous_batch_id)]
+    rows = build_forecast_diffs(batch_id, previous_batch_id, records, previous_records)
+    session.query(ForecastDiff).filter(ForecastDiff.batch_id == batch_id).delete(synchronize_session=False)
+    session.bulk_insert_mappings(ForecastDiff, rows)
+    logger.info(f"Built {len(rows)} forecast diffs for batch {batch_id} against batch {previous_batch_id}.")
+
+def build_missing_forecast_diffs() -> None:
+    """
+    Make sure every active batch has its diffs against the batch before it, for batches stored before diffs
+    existed or finished out of order, and for batches whose previous batch changed.
+    """
+    session = SessionLocal()
+    try:
+        batches = session.query(BatchMetadata.batch_id).filter(
+            BatchMetadata.status == "ACTIVE",
+            BatchMetadata.alias_of.is_(None),
+        ).order_by(BatchMetadata.forecast_time, BatchMetadata.batch_id).all()
+        for previous, batch in zip(batches, batches[1:]):
+            built = session.query(exists().where(
+                ForecastDiff.batch_id == batch.batch_id,
+                ForecastDiff.previous_batch_id == previous.batch_id,
+            )).scalar()
+            if not built:
+                store_forecast_diffs(session, batch.batch_id, previous.batch_id)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error building missing forecast diffs: {e}")
+    finally:
+        session.close()
+
 def update_metadata_status(session, metadata):
     metadata.status = "ACTIVE"
     metadata.end_ingest_time = datetime.now()
     session.commit()
 
+def snapshot_batch(batch_id, batch_forecast_time, batch_data, alias_of=None) -> None:
+    """
+    Export a newly activated batch from the fetched records and publish the active set.
+    An alias is served from its original's snapshot, so it is only published.
+    """
+    if not snapshots_enabled():
+        return
+    if alias_of is None:
+        try:
+            export_snapshot(batch_id, batch_forecast_time, batch_data)
+        except Exception as e:
+            logger.error(f"Error exporting snapshot for batch {batch_id}: {e}")
+    refresh_snapshots()
+
+@stage("snapshot")
+def refresh_snapshots() -> None:
+    """Export a snapshot for any active batch missing one and publish the active set to the API workers."""
+    if not snapshots_enabled():
+        return
+    session = SessionLocal()
+    try:
+        active_batches = session.query(BatchMetadata).filter(
+            BatchMetadata.status == "ACTIVE"
+        ).order_by(BatchMetadata.forecast_time).all()
+
+        # Aliases share their original's snapshot instead of serving the same rows twice.
+        stored_batches = [batch for batch in active_batches if batch.alias_of is None]
+        for batch in stored_batches:
+            if not has_snapshot(batch.batch_id):
+                rows = fetch_batch_records(session, batch.batch_id)
+                export_snapshot(batch.batch_id, batch.forecast_time, [row._mapping for row in rows])
+
+        publish_snapshots(
+            [batch.batch_id for batch in stored_batches],
+            aliases={batch.batch_id: batch.alias_of for batch in active_batches if batch.alias_of is not None},
+        )
+    except Exception as e:
+        logger.error(f"Error refreshing snapshots: {e}")
+    finally:
+        session.close()
+
 def process_batch_weather_data(batch_id, batch_forecast_time, batch_data):
     weather_records = [
             WeatherData(
@@ -204,17 +517,20 @@ def process_batch_weather_data(batch_id, batch_forecast_time, batch_data):
 
 async def initialize_metadata(session, batch_id, batch_forecast_time):
     total_pages = await fetch_total_pages(batch_id)
-    batch_data = await fetch_batch_data(batch_id, total_pages)
+    batch_pages = await fetch_batch_pages(batch_id, total_pages)
+    page_hashes = [hash_page(page) for page in batch_pages]
     metadata = BatchMetadata(
             batch_id=batch_id,
             forecast_time=batch_forecast_time,
             status="RUNNING",
-            number_of_rows=len(batch_data),
+            number_of_rows=sum(len(page) for page in batch_pages),
             start_ingest_time=datetime.now(),
+            page_hashes=page_hashes,
+            content_hash=hash_batch(page_hashes),
         )
     session.add(metadata)
     session.commit()
-    return batch_data,metadata
+    return batch_pages,metadata
 
 @retry(
     stop=stop_after_attempt(5),
@@ -228,12 +544,16 @@ async def process_single_batch(batch: Dict[str, Union[str, int]]) -> None:
     except Exception as e:
         logger.error(f"Error processing batch {batch['batch_id']}: {e}. Skipping this batch.")
 
+@stage("cleanup")
 def perform_cleanup_tasks() -> None:
     """Perform all cleanup tasks."""
     tasks = [
         (delete_old_active_batches, "Error deleting old active batches"),
         (delete_weather_data_for_non_retained_batches, "Error deleting weather data for non-retained batches"),
         (retain_metadata_for_deleted_batches, "Error retaining metadata for deleted batches"),
+        (delete_finished_tasks, "Error deleting finished tasks"),
+        (build_missing_sketches, "Error building missing sketches"),
+        (build_missing_forecast_diffs, "Error building missing forecast diffs"),
     ]
 
     for task, error_message in tasks:
@@ -258,11 +578,40 @@ async def process_batches() -> None:
 
         # Perform cleanup tasks
         perform_cleanup_tasks()
+        refresh_snapshots()
 
         logger.info("Batch processing completed successfully.")
 
     except Exception as e:
         logger.error(f"Critical error in the batch processing pipeline: {e}")
 
+async def keep_running_ingestion() -> None:
+    """Continuously run the ingestion service in a loop."""
+    while True:
+        start_time = datetime.now()
+        logger.info(f"[{start_time}] Starting ingestion service")
+
+        try:
+            await process_batches()
+        except Exception as e:
+            logger.error(f"[{datetime.now()}] Error in ingestion service: {e}")
+
+        end_time = datetime.now()
+        duration = (end_time - start_time).total_seconds()
+        logger.info(f"[{end_time}] Ingestion service completed. Duration: {duration:.2f} seconds.")
+
+        logger.info(f"[{datetime.now()}] Waiting before the next ingestion cycle")
+        await asyncio.sleep(INGESTION_INTERVAL_SECONDS)
+
+def main() -> None:
+    """Run the ingestion service, separately from the API workers."""
+    parser = argparse.ArgumentParser(description="Ingest weather batches from the external API.")
+    parser.add_argument("--once", action="store_true", help="Run a single ingestion cycle and exit.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    init_db()
+    asyncio.run(process_batches() if args.once else keep_running_ingestion())
+
 if __name__ == "__main__":
-    asyncio.run(process_batches())
+    main()
@@ -1,46 +1,48 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, request, jsonify
 import logging
+import time
+from dateutil.parser import isoparse
+from config import QUERY_STATS_ENDPOINT, RASTER_MAX_SIZE, TILE_SIZE
+from server.admission import admission_stats, admit, check_pool_capacity
 from server.database import init_db
-from server.ingestion_service import process_batches
-from server.utils import fetch_weather_data, summarize_weather_data, fetch_batches, format_weather_data, format_weather_summary
-import asyncio
-import threading
-import datetime
+from server.forecast_diffs import DEFAULT_TOP_CHANGES, MAX_TOP_CHANGES, format_point_changes, format_top_changes
+from server.http_cache import conditional, compress_response
+from server.profiling import init_app as init_profiling, query_stats, timed
+from server.sketches import cell_bbox, format_sketch_summary
+from server.snapshots import METRICS
+from server.tiles import FORMATS, MAX_ZOOM, render_bbox, render_tile, value_range
+from server.utils import (fetch_weather_data, summarize_weather_data, fetch_batches, format_weather_data, format_weather_summary,
+                          fetch_point_sketches, fetch_region_sketches, fetch_point_changes, fetch_top_changes)
 
-app = Flask(__name__)
+api = Blueprint("api", __name__)
+
+# /weather/summarize parameters answered from the stored sketches instead of the snapshots
+SKETCH_PARAMETERS = {"bbox", "percentiles", "histogram"}
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def start_ingestion_service():
+def create_app(check_schema: bool = True) -> Flask:
     """
-    Start the ingestion service in a background thread.
+    Create the API application.
+    Importing this module has no side effects: the schema check runs here, and ingestion
+    runs as a separate process (python -m server.ingestion_service).
     """
-    logger.info("Starting the ingestion services")
-    threading.Thread(target=lambda: asyncio.run(keep_running_ingestion()), daemon=True).start()
-    logger.info("Ingestion service started.")
+    start_time = time.perf_counter()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+    app = Flask(__name__)
+    init_profiling(app)
+    app.after_request(compress_response)
+    app.register_blueprint(api)
+    check_pool_capacity()
+    if QUERY_STATS_ENDPOINT:
+        app.add_url_rule("/stats/queries", view_func=get_query_stats, methods=["GET"])
 
-async def keep_running_ingestion():
-    """
-    Continuously run the ingestion service in a loop.
-    """
-    while True:
-        start_time = datetime.datetime.now()
-        logger.info(f"[{start_time}] Starting ingestion service")
-        
-        try:
-            await process_batches()
-        except Exception as e:
-            logger.error(f"[{datetime.datetime.now()}] Error in ingestion service: {e}")
-        
-        end_time = datetime.datetime.now()
-        duration = (end_time - start_time).total_seconds()
-        logger.info(f"[{end_time}] Ingestion service completed. Duration: {duration:.2f} seconds.")
-        
-        logger.info(f"[{datetime.datetime.now()}] Waiting before the next ingestion cycle")
-        await asyncio.sleep(300)  # Wait 10 minutes before the next cycle
+    if check_schema:
+        initialize_system()
+    logger.info(f"App created in {time.perf_counter() - start_time:.3f} seconds.")
+    return app
 
 
 # Initialize the system
@@ -50,59 +52,278 @@ def initialize_system():
     """
     init_db()
     logger.info("Database initialized successfully.")
+
+
+def parse_weather_filters():
+    """
+    Parse the optional start/end forecast_time and batch_id query parameters.
+    Raises ValueError if start or end is not an ISO 8601 timestamp.
+    """
+    start = request.args.get("start")
+    end = request.args.get("end")
+    return {
+        "start": isoparse(start) if start else None,
+        "end": isoparse(end) if end else None,
+        "batch_id": request.args.get("batch_id"),
+    }
  
     
-@app.route("/weather/data", methods=["GET"])
+def parse_bbox():
+    """
+    Parse the bbox query parameter, min_lon,min_lat,max_lon,max_lat.
+    Raises ValueError if it is malformed or empty.
+    """
+    try:
+        bbox = tuple(float(v) for v in request.args.get("bbox", "").split(","))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        raise ValueError("Invalid bbox, expected min_lon,min_lat,max_lon,max_lat")
+    return bbox
+
+
+def parse_summary_options():
+    """
+    Parse the optional percentiles (comma-separated, 0 to 100) and histogram (true/false) query parameters.
+    Raises ValueError if percentiles are invalid.
+    """
+    percentiles = request.args.get("percentiles")
+    try:
+        percentiles = [float(p) for p in percentiles.split(",")] if percentiles else []
+    except ValueError:
+        percentiles = [-1.0]
+    if any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError("Invalid percentiles, expected comma-separated numbers from 0 to 100")
+    return percentiles, request.args.get("histogram", "false").lower() == "true"
+
+
+def parse_raster_options(metric):
+    """
+    Parse the optional batch_id, format (png or f32) and PNG value range (vmin, vmax) query parameters.
+    Raises ValueError if they are invalid.
+    """
+    fmt = request.args.get("format", "png")
+    if fmt not in FORMATS:
+        raise ValueError(f"Invalid format, expected one of {', '.join(FORMATS)}")
+    vmin, vmax = value_range(metric, request.args.get("vmin", type=float), request.args.get("vmax", type=float))
+    if vmin >= vmax:
+        raise ValueError("vmin must be lower than vmax")
+    return {"batch_id": request.args.get("batch_id"), "fmt": fmt, "vmin": vmin, "vmax": vmax}
+
+
+def raster_response(raster):
+    """
+    Build the response for a rendered raster, or a 404 when there is no matching active batch.
+    """
+    if raster is None:
+        return jsonify({"error": "No matching active batch"}), 404
+    return Response(raster.body, mimetype=raster.mimetype, headers=raster.headers)
+
+
+@api.route("/weather/data", methods=["GET"])
+@admit("weather_data")
+@conditional(snapshots=True)
 def get_weather_data():
     latitude = request.args.get("latitude", type=float)
     longitude = request.args.get("longitude", type=float)
 
     if latitude is None or longitude is None:
         return jsonify({"error": "Missing latitude or longitude"}), 400
+
+    try:
+        filters = parse_weather_filters()
+    except ValueError:
+        return jsonify({"error": "Invalid start or end, expected an ISO 8601 timestamp"}), 400
     
     try:
-        data = fetch_weather_data(latitude, longitude)
-        formatted_data = format_weather_data(data)
-        return jsonify(formatted_data)
+        data = fetch_weather_data(latitude, longitude, **filters)
+        with timed("serialize"):
+            formatted_data = format_weather_data(data)
+            return jsonify(formatted_data)
     except Exception as e:
+        logger.exception(f"Error serving weather data: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/weather/summarize", methods=["GET"])
+@api.route("/weather/summarize", methods=["GET"])
+@admit("summarize")
+@conditional(snapshots=lambda: not request.args.keys() & SKETCH_PARAMETERS)
 def summarize_weather():
     latitude = request.args.get("latitude", type=float)
     longitude = request.args.get("longitude", type=float)
+    region = "bbox" in request.args
+
+    if not region and (latitude is None or longitude is None):
+        return jsonify({"error": "Missing latitude or longitude"}), 400
+
+    try:
+        filters = parse_weather_filters()
+    except ValueError:
+        return jsonify({"error": "Invalid start or end, expected an ISO 8601 timestamp"}), 400
+
+    try:
+        bbox = parse_bbox() if region else None
+        percentiles, histogram = parse_summary_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        if region or percentiles or histogram:
+            # Percentiles and histograms come from sketches: the stored ones of a region's cells, or built from a point's rows.
+            if region:
+                sketches = fetch_region_sketches(bbox, **filters)
+            else:
+                sketches = fetch_point_sketches(latitude, longitude, **filters)
+            with timed("serialize"):
+                summary = format_sketch_summary(sketches, percentiles, histogram)
+                if region:
+                    # The region actually summarized: the bbox extended to whole sketch cells
+                    summary["bbox"] = list(cell_bbox(bbox))
+                return jsonify(summary)
+
+        summary = summarize_weather_data(latitude, longitude, **filters)
+        with timed("serialize"):
+            formatted_summary = format_weather_summary(summary)
+            return jsonify(formatted_summary)
+    except Exception as e:
+        logger.exception(f"Error summarizing weather data: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/weather/changes", methods=["GET"])
+@admit("changes")
+@conditional
+def get_weather_changes():
+    """
+    How the forecast at a point changed between each pair of consecutive active batches.
+    """
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
 
     if latitude is None or longitude is None:
         return jsonify({"error": "Missing latitude or longitude"}), 400
-    
+
+    try:
+        changes = fetch_point_changes(latitude, longitude)
+        with timed("serialize"):
+            return jsonify(format_point_changes(changes))
+    except Exception as e:
+        logger.exception(f"Error fetching weather changes: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/weather/changes/top/<metric>", methods=["GET"])
+@admit("changes")
+@conditional
+def get_top_weather_changes(metric):
+    """
+    The points whose metric changed the most between an active batch (the latest by default) and the one
+    before it, optionally inside a bbox.
+    """
+    if metric not in METRICS:
+        return jsonify({"error": f"Invalid metric, expected one of {', '.join(METRICS)}"}), 400
+
+    limit = request.args.get("limit", DEFAULT_TOP_CHANGES, type=int)
+    if not 0 < limit <= MAX_TOP_CHANGES:
+        return jsonify({"error": f"Invalid limit, expected 1 to {MAX_TOP_CHANGES}"}), 400
+    try:
+        bbox = parse_bbox() if "bbox" in request.args else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        result = fetch_top_changes(metric, bbox, limit, request.args.get("batch_id"))
+        if result is None:
+            return jsonify({"error": "No active batch with a previous active batch to compare against"}), 404
+        with timed("serialize"):
+            return jsonify(format_top_changes(result[0], result[1], metric, result[2]))
+    except Exception as e:
+        logger.exception(f"Error fetching top weather changes: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/weather/tiles/<metric>/<int:z>/<int:x>/<int:y>", methods=["GET"])
+@admit("tiles")
+@conditional(snapshots=True)
+def get_weather_tile(metric, z, x, y):
+    """
+    A Web Mercator tile of a metric over one active batch, the latest one by default.
+    """
+    if metric not in METRICS:
+        return jsonify({"error": f"Invalid metric, expected one of {', '.join(METRICS)}"}), 400
+    if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({"error": "Invalid tile coordinates"}), 400
+
     try:
-        summary = summarize_weather_data(latitude, longitude)
-        formatted_summary = format_weather_summary(summary)
-        
-        # Store the result in the cache
-        
-        return jsonify(formatted_summary)
+        options = parse_raster_options(metric)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        return raster_response(render_tile(metric, z, x, y, **options))
+    except Exception as e:
+        logger.exception(f"Error rendering weather tile: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/weather/raster/<metric>", methods=["GET"])
+@admit("tiles")
+@conditional(snapshots=True)
+def get_weather_raster(metric):
+    """
+    A metric over a lat/lon bounding box (bbox=min_lon,min_lat,max_lon,max_lat), width x height pixels.
+    """
+    if metric not in METRICS:
+        return jsonify({"error": f"Invalid metric, expected one of {', '.join(METRICS)}"}), 400
+
+    width = request.args.get("width", TILE_SIZE, type=int)
+    height = request.args.get("height", TILE_SIZE, type=int)
+    try:
+        bbox = parse_bbox()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not (0 < width <= RASTER_MAX_SIZE and 0 < height <= RASTER_MAX_SIZE):
+        return jsonify({"error": f"Invalid width or height, expected 1 to {RASTER_MAX_SIZE} pixels"}), 400
+
+    try:
+        options = parse_raster_options(metric)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        return raster_response(render_bbox(metric, bbox, width, height, **options))
     except Exception as e:
+        logger.exception(f"Error rendering weather raster: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/batches", methods=["GET"])
+@api.route("/batches", methods=["GET"])
+@admit("batches")
+@conditional
 def get_batches():
     try:
         # Fetch batch data from the database
         batches = fetch_batches()
-        formatted_batches = [{
-            "batch_id": b.batch_id,
-            "forecast_time": b.forecast_time,
-            "number_of_rows": b.number_of_rows,
-            "start_ingest_time": b.start_ingest_time,
-            "end_ingest_time": b.end_ingest_time,
-            "status": b.status,
-        } for b in batches]
-                
-        return jsonify(formatted_batches)
+        with timed("serialize"):
+            formatted_batches = [{
+                "batch_id": b.batch_id,
+                "forecast_time": b.forecast_time,
+                "number_of_rows": b.number_of_rows,
+                "start_ingest_time": b.start_ingest_time,
+                "end_ingest_time": b.end_ingest_time,
+                "status": b.status,
+            } for b in batches]
+            return jsonify(formatted_batches)
     except Exception as e:
+        logger.exception(f"Error fetching batches: {e}")
         return jsonify({"error": str(e)}), 500
 
-# start app
-initialize_system()
-start_ingestion_service()
\ No newline at end of file
+
+def get_query_stats():
+    """
+    Per-statement latency and row counts recorded by this worker, slowest total first.
+    Registered by create_app only with QUERY_STATS_ENDPOINT, since it exposes the SQL of every query.
+    """
+    return jsonify(query_stats())
+
+
+@api.route("/stats/admission", methods=["GET"])
+def get_admission_stats():
+    """
+    In-flight, queued and shed request counters of each admission budget in this worker.
+    """
+    return jsonify(admission_stats())
@@ -1,5 +1,5 @@
-from sqlalchemy import (TIMESTAMP, Boolean, Column, Float, Index, Integer,
-                        String)
+from sqlalchemy import (JSON, TIMESTAMP, Boolean, Column, Float, Index, Integer,
+                        LargeBinary, PrimaryKeyConstraint, String, UniqueConstraint)
 from sqlalchemy.dialects.postgresql import TIMESTAMP as PG_TIMESTAMP
 from sqlalchemy.sql import func
 
@@ -18,7 +18,12 @@ class WeatherData(Base):
     humidity = Column(Float)
     
     __table_args__ = (
-        Index("ix_weather_lat_lon_time", "latitude", "longitude", "forecast_time"),
+        # Covering index: lookups by location/time range are answered with an
+        # index-only scan, without visiting the heap.
+        Index(
+            "ix_weather_lat_lon_time", "latitude", "longitude", "forecast_time",
+            postgresql_include=["batch_id", "temperature", "precipitation_rate", "humidity"],
+        ),
         Index("ix_weather_id", "batch_id"),
     )
 
@@ -33,7 +38,78 @@ class BatchMetadata(Base):
     end_ingest_time = Column(PG_TIMESTAMP(timezone=True), nullable=True)
     status = Column(String, nullable=False)  # ACTIVE, INACTIVE 
     retained = Column(Boolean, default=True)  
+    content_hash = Column(String, nullable=True)  # sha256 over the page hashes
+    page_hashes = Column(JSON, nullable=True)  # sha256 of each page's records, in page order
+    alias_of = Column(String, nullable=True)  # Identical batch whose rows are served for this one
+    delta_base = Column(String, nullable=True)  # Batch this one only stores the changed points against
 
     __table_args__ = (
         Index("ix_batch_active", "status", postgresql_where=(status == "ACTIVE")),
-    )
\ No newline at end of file
+        Index("ix_batch_content_hash", "content_hash"),
+    )
+
+class IngestTask(Base):
+    """One page of a batch to ingest, claimed by workers with SELECT ... FOR UPDATE SKIP LOCKED."""
+    __tablename__ = "ingest_tasks"
+
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String, nullable=False)
+    page = Column(Integer, nullable=False)
+    forecast_time = Column(PG_TIMESTAMP(timezone=True), nullable=False)
+    status = Column(String, nullable=False, default="PENDING")  # PENDING, RUNNING, DONE, FAILED
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_expires_at = Column(PG_TIMESTAMP(timezone=True), nullable=True)
+    heartbeat_at = Column(PG_TIMESTAMP(timezone=True), nullable=True)
+    page_hash = Column(String, nullable=True)
+    number_of_rows = Column(Integer, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(PG_TIMESTAMP(timezone=True), nullable=False, default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("batch_id", "page", name="uq_ingest_task_page"),
+        Index("ix_ingest_tasks_claimable", "id", postgresql_where=status.in_(["PENDING", "RUNNING"])),
+    )
+
+
+class WeatherSketch(Base):
+    """Fixed-bin histogram of one metric over the points of a batch in one lat/lon cell, built at ingest."""
+    __tablename__ = "weather_sketches"
+
+    batch_id = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)
+    cell_lat = Column(Integer, primary_key=True)  # floor(latitude / SKETCH_CELL_DEGREES)
+    cell_lon = Column(Integer, primary_key=True)  # floor(longitude / SKETCH_CELL_DEGREES)
+    count = Column(Integer, nullable=False)
+    minimum = Column(Float, nullable=True)
+    maximum = Column(Float, nullable=True)
+    total = Column(Float, nullable=False)
+    bins = Column(LargeBinary, nullable=False)  # Non-empty bins: uint16 indexes then uint32 counts, little-endian
+
+
+class ForecastDiff(Base):
+    """Change of each metric at a point between a batch and the previous active batch, built at ingest."""
+    __tablename__ = "forecast_diffs"
+
+    batch_id = Column(String, nullable=False)
+    previous_batch_id = Column(String, nullable=False)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    temperature = Column(Float)  # Value in batch_id minus value in previous_batch_id
+    precipitation_rate = Column(Float)
+    humidity = Column(Float)
+
+    __table_args__ = (
+        # Point lookups across batches, and bbox rankings over a small region
+        PrimaryKeyConstraint("latitude", "longitude", "batch_id"),
+        # Top changes of a batch: read in order, largest absolute change first
+        Index("ix_forecast_diffs_temperature", "batch_id", func.abs(temperature).desc().nullslast()),
+        Index("ix_forecast_diffs_precipitation_rate", "batch_id", func.abs(precipitation_rate).desc().nullslast()),
+        Index("ix_forecast_diffs_humidity", "batch_id", func.abs(humidity).desc().nullslast()),
+    )
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
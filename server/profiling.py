@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Optional
+
+from flask import g, request
+from sqlalchemy import event
+
+from config import EXPLAIN_SAMPLE_RATE, QUERY_STATS_MAX_ENTRIES, SLOW_QUERY_THRESHOLD_MS
+
+logger = logging.getLogger(__name__)
+
+# Origin of the statements executed in the current context, e.g. "route:get_weather_data" or "ingest:insert".
+_query_tag: ContextVar[str] = ContextVar("query_tag", default="untagged")
+# Per-request timing accumulator, None outside of a request.
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("timings", default=None)
+
+_stats_lock = threading.Lock()
+# Keyed by (tag, statement) in least recently run order, bounded since statement texts can vary without limit
+_query_stats: "OrderedDict[tuple, Dict[str, float]]" = OrderedDict()
+
+
+@contextmanager
+def tagged(tag: str):
+    """Tag the statements executed inside the block with their origin."""
+    token = _query_tag.set(tag)
+    try:
+        yield
+    finally:
+        _query_tag.reset(token)
+
+
+def stage(name: str):
+    """Decorator tagging the statements of an ingestion stage, for sync and async functions."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tagged(f"ingest:{name}"):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tagged(f"ingest:{name}"):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_timing(name: str, duration_ms: float) -> None:
+    """Add a duration to the current request's timings, if any."""
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + duration_ms
+        timings[f"{name}_count"] = timings.get(f"{name}_count", 0) + 1
+
+
+@contextmanager
+def timed(name: str):
+    """Time the block into the current request's timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, (time.perf_counter() - start) * 1000)
+
+
+def query_stats():
+    """
+    Return per (tag, statement) count, total/max latency and rows since the process started,
+    for the QUERY_STATS_MAX_ENTRIES most recently run statements.
+    """
+    with _stats_lock:
+        return [
+            {"tag": tag, "statement": statement, **stats}
+            for (tag, statement), stats in sorted(_query_stats.items(), key=lambda item: -item[1]["total_ms"])
+        ]
+
+
+def instrument_engine(engine) -> None:
+    """Record latency and row counts of every statement executed through the engine."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context rather than the connection, so a statement that fails
+    # (no after_cursor_execute) leaves nothing behind on the pooled connection.
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - context._query_start) * 1000
+    rows = max(cursor.rowcount, 0)
+    tag = _query_tag.get()
+    record_timing("db", duration_ms)
+
+    with _stats_lock:
+        key = (tag, statement)
+        stats = _query_stats.get(key)
+        if stats is None:
+            stats = _query_stats[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0}
+            if len(_query_stats) > QUERY_STATS_MAX_ENTRIES:
+                _query_stats.popitem(last=False)
+        else:
+            _query_stats.move_to_end(key)
+        stats["count"] += 1
+        stats["total_ms"] += duration_ms
+        stats["max_ms"] = max(stats["max_ms"], duration_ms)
+        stats["rows"] += rows
+
+    logger.debug(f"[{tag}] {duration_ms:.1f} ms, {rows} rows: {statement}")
+    if duration_ms >= SLOW_QUERY_THRESHOLD_MS:
+        logger.warning(f"Slow query [{tag}] {duration_ms:.1f} ms, {rows} rows: {statement}")
+        if _is_explainable(statement, executemany) and random.random() < EXPLAIN_SAMPLE_RATE:
+            _log_query_plan(conn, statement, parameters, tag)
+
+
+def _is_explainable(statement: str, executemany: bool) -> bool:
+    """EXPLAIN ANALYZE executes the statement again, so only sample plain reads."""
+    normalized = statement.lstrip().upper()
+    return not executemany and normalized.startswith("SELECT") and "FOR UPDATE" not in normalized
+
+
+def _log_query_plan(conn, statement, parameters, tag) -> None:
+    """Log EXPLAIN (ANALYZE, BUFFERS) for a sampled slow query."""
+    # A raw DBAPI cursor does not fire the engine events, and the savepoint keeps a failing
+    # EXPLAIN from aborting the caller's transaction.
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT profiling_explain")
+        try:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            logger.warning(f"Plan for slow query [{tag}]:\n{plan}")
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT profiling_explain")
+            cursor.execute("RELEASE SAVEPOINT profiling_explain")
+    except Exception as e:
+        logger.error(f"Error capturing plan for slow query [{tag}]: {e}")
+    finally:
+        cursor.close()
+
+
+def init_app(app) -> None:
+    """
+    Tag each request's statements with its route and add a Server-Timing header
+    breaking the request down into DB, serialization and total time.
+    """
+    @app.before_request
+    def start_request_profiling():
+        g.profiling_start = time.perf_counter()
+        g.profiling_tokens = (
+            _query_tag.set(f"route:{request.endpoint}"),
+            _timings.set({}),
+        )
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = _timings.get()
+        if timings is None or "profiling_start" not in g:
+            return response
+        total_ms = (time.perf_counter() - g.profiling_start) * 1000
+        metrics = [f'db;dur={timings.get("db", 0.0):.1f};desc="{timings.get("db_count", 0)} queries"']
+        if "serialize" in timings:
+            metrics.append(f'serialize;dur={timings["serialize"]:.1f}')
+        metrics.append(f"total;dur={total_ms:.1f}")
+        response.headers["Server-Timing"] = ", ".join(metrics)
+        return response
+
+    @app.teardown_request
+    def end_request_profiling(exc):
+        tokens = g.pop("profiling_tokens", None)
+        if tokens is not None:
+            tag_token, timings_token = tokens
+            _timings.reset(timings_token)
+            _query_tag.reset(tag_token)
@@ -0,0 +1,206 @@
+import math
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from config import SKETCH_CELL_DEGREES
+from server.snapshots import METRICS
+
+# Fixed bins per metric: (lower edge, bin width, number of bins). Values outside the range are counted
+# in the first or last bin. Fixed bins make sketches of different batches and cells mergeable by addition.
+BINS = {
+    "temperature": (-60.0, 0.5, 400),
+    "precipitation_rate": (0.0, 0.05, 400),
+    "humidity": (0.0, 0.5, 200),
+}
+
+
+def bin_index(metric: str, values: np.ndarray) -> np.ndarray:
+    """Bin of each value, clamped to the first and last bin."""
+    low, width, size = BINS[metric]
+    return np.clip(np.floor((values - low) / width), 0, size - 1).astype(np.int64)
+
+
+def encode_bins(indexes: np.ndarray, counts: np.ndarray) -> bytes:
+    """Encode the non-empty bins: their uint16 indexes then their uint32 counts, little-endian."""
+    return indexes.astype("<u2").tobytes() + counts.astype("<u4").tobytes()
+
+
+def cell_index(value: float) -> int:
+    """The sketch cell of a latitude or longitude."""
+    return math.floor(value / SKETCH_CELL_DEGREES)
+
+
+def cell_bbox(bbox) -> Tuple[float, float, float, float]:
+    """
+    The extent of the cells overlapping a bounding box (min_lon, min_lat, max_lon, max_lat),
+    which is the region a summary merged from their sketches covers.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (
+        cell_index(min_lon) * SKETCH_CELL_DEGREES,
+        cell_index(min_lat) * SKETCH_CELL_DEGREES,
+        (cell_index(max_lon) + 1) * SKETCH_CELL_DEGREES,
+        (cell_index(max_lat) + 1) * SKETCH_CELL_DEGREES,
+    )
+
+
+class Sketch:
+    """
+    Fixed-bin histogram of a metric with its exact count, minimum, maximum and total.
+    Percentiles are interpolated within a bin, so they are accurate to one bin width,
+    except for sketches built with their values kept, whose percentiles are exact.
+    """
+
+    def __init__(self, metric: str, counts: Optional[np.ndarray] = None,
+                 minimum: Optional[float] = None, maximum: Optional[float] = None, total: float = 0.0,
+                 values: Optional[np.ndarray] = None):
+        self.metric = metric
+        self.counts = np.zeros(BINS[metric][2], dtype=np.int64) if counts is None else counts
+        self.minimum = minimum
+        self.maximum = maximum
+        self.total = total
+        self.values = values
+
+    @classmethod
+    def from_values(cls, metric: str, values: Iterable[Optional[float]], keep_values: bool = False) -> "Sketch":
+        """Build a sketch from values, ignoring missing ones. Keeping the values makes percentiles exact."""
+        values = np.asarray(list(values), dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return cls(metric, values=values if keep_values else None)
+        counts = np.bincount(bin_index(metric, values), minlength=BINS[metric][2])
+        return cls(metric, counts, float(values.min()), float(values.max()), float(values.sum()),
+                   values if keep_values else None)
+
+    @classmethod
+    def decode(cls, metric: str, bins: bytes, minimum: Optional[float], maximum: Optional[float], total: float) -> "Sketch":
+        """Rebuild a sketch stored in weather_sketches."""
+        size = len(bins) // 6
+        counts = np.zeros(BINS[metric][2], dtype=np.int64)
+        counts[np.frombuffer(bins, dtype="<u2", count=size)] = np.frombuffer(bins, dtype="<u4", offset=2 * size)
+        return cls(metric, counts, minimum, maximum, total)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def merge(self, other: "Sketch") -> "Sketch":
+        """Add another sketch of the same metric into this one."""
+        self.counts += other.counts
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.total += other.total
+        self.values = None
+        return self
+
+    def mean(self) -> Optional[float]:
+        count = self.count
+        return self.total / count if count else None
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Interpolate a percentile (0 to 100) within its bin, clamped to the exact minimum and maximum.
+        Computed from the values instead when they were kept.
+        """
+        count = self.count
+        if not count:
+            return None
+        if self.values is not None:
+            return float(np.percentile(self.values, percentile))
+        low, width, _ = BINS[self.metric]
+        cumulative = np.cumsum(self.counts)
+        rank = percentile / 100 * count
+        index = min(int(np.searchsorted(cumulative, rank, side="left")), len(cumulative) - 1)
+        below = cumulative[index] - self.counts[index]
+        fraction = (rank - below) / self.counts[index] if self.counts[index] else 0.0
+        value = low + (index + fraction) * width
+        return float(min(max(value, self.minimum), self.maximum))
+
+    def histogram(self) -> Dict:
+        """The non-empty bins, as the lower edge of each bin and its count."""
+        low, width, _ = BINS[self.metric]
+        indexes = np.flatnonzero(self.counts)
+        return {
+            "bin_width": width,
+            "bins": [[round(low + int(i) * width, 6), int(self.counts[i])] for i in indexes],
+        }
+
+
+def build_batch_sketches(batch_id: str, records: List[Mapping]) -> List[Dict]:
+    """
+    Build the weather_sketches rows of a batch: one sketch per metric and lat/lon cell.
+    Records are grouped by cell and binned with NumPy, without a Python loop over records.
+    A batch without any value gets a single empty sketch, so it is known to be sketched.
+    """
+    if not records:
+        return [empty_sketch_row(batch_id)]
+    latitudes = np.array([record["latitude"] for record in records], dtype=np.float64)
+    longitudes = np.array([record["longitude"] for record in records], dtype=np.float64)
+    cells = np.floor(np.stack([latitudes, longitudes], axis=1) / SKETCH_CELL_DEGREES).astype(np.int64)
+    unique_cells, cell_ids = np.unique(cells, axis=0, return_inverse=True)
+    cell_ids = cell_ids.reshape(-1)
+
+    rows = []
+    for metric in METRICS:
+        values = np.array([record.get(metric) for record in records], dtype=np.float64)
+        valid = ~np.isnan(values)
+        order = np.argsort(cell_ids[valid], kind="stable")
+        metric_cells, metric_values = cell_ids[valid][order], values[valid][order]
+        if not len(metric_values):
+            continue
+
+        # Per-cell count/min/max/total over runs of the same cell, and per-(cell, bin) counts.
+        starts = np.flatnonzero(np.r_[True, metric_cells[1:] != metric_cells[:-1]])
+        minimums = np.minimum.reduceat(metric_values, starts)
+        maximums = np.maximum.reduceat(metric_values, starts)
+        totals = np.add.reduceat(metric_values, starts)
+        size = BINS[metric][2]
+        keys, key_counts = np.unique(metric_cells * size + bin_index(metric, metric_values), return_counts=True)
+        key_cells = keys // size
+
+        for position, start in enumerate(starts):
+            cell = metric_cells[start]
+            lo = np.searchsorted(key_cells, cell, side="left")
+            hi = np.searchsorted(key_cells, cell, side="right")
+            rows.append({
+                "batch_id": batch_id,
+                "metric": metric,
+                "cell_lat": int(unique_cells[cell, 0]),
+                "cell_lon": int(unique_cells[cell, 1]),
+                "count": int(key_counts[lo:hi].sum()),
+                "minimum": float(minimums[position]),
+                "maximum": float(maximums[position]),
+                "total": float(totals[position]),
+                "bins": encode_bins(keys[lo:hi] % size, key_counts[lo:hi]),
+            })
+    return rows or [empty_sketch_row(batch_id)]
+
+
+def empty_sketch_row(batch_id: str) -> Dict:
+    """An empty sketch, which adds nothing when merged."""
+    return {
+        "batch_id": batch_id, "metric": METRICS[0], "cell_lat": 0, "cell_lon": 0,
+        "count": 0, "minimum": None, "maximum": None, "total": 0.0, "bins": b"",
+    }
+
+
+def merge_sketches(rows) -> Dict[str, Sketch]:
+    """Merge stored sketches per metric. Every metric gets a sketch, empty if no row has it."""
+    merged = {metric: Sketch(metric) for metric in METRICS}
+    for row in rows:
+        merged[row.metric].merge(Sketch.decode(row.metric, row.bins, row.minimum, row.maximum, row.total))
+    return merged
+
+
+def format_sketch_summary(sketches: Dict[str, Sketch], percentiles: Optional[List[float]] = None, histogram: bool = False) -> Dict:
+    """Format sketches like format_weather_summary, with the requested percentiles and histograms."""
+    summary = {}
+    for metric, sketch in sketches.items():
+        summary[metric] = {"max": sketch.maximum, "min": sketch.minimum, "avg": sketch.mean(), "count": sketch.count}
+        if percentiles:
+            summary[metric]["percentiles"] = {f"{p:g}": sketch.percentile(p) for p in percentiles}
+        if histogram:
+            summary[metric]["histogram"] = sketch.histogram()
+    return summary
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Mapping, Optional
+from urllib.parse import quote
+
+import numpy as np
+from dateutil.parser import isoparse
+
+from config import SNAPSHOT_DIR
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("temperature", "precipitation_rate", "humidity")
+COLUMNS = ("latitude", "longitude") + METRICS
+MANIFEST_FILE = "manifest.json"
+META_FILE = "meta.json"
+
+WeatherRecord = namedtuple(
+    "WeatherRecord",
+    ["latitude", "longitude", "forecast_time", "temperature", "precipitation_rate", "humidity"],
+)
+WeatherSummary = namedtuple(
+    "WeatherSummary",
+    [f"{stat}_{metric}" for metric in METRICS for stat in ("max", "min", "avg")],
+)
+
+
+def snapshots_enabled() -> bool:
+    """Snapshot serving is enabled by setting SNAPSHOT_DIR."""
+    return bool(SNAPSHOT_DIR)
+
+
+def _utc(value):
+    """Treat naive datetimes as UTC so they compare with snapshot forecast times."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _batch_dir(directory: str, batch_id: str) -> str:
+    return os.path.join(directory, quote(batch_id, safe=""))
+
+
+def has_snapshot(batch_id: str, directory: str = SNAPSHOT_DIR) -> bool:
+    """Check whether a batch has already been exported."""
+    return os.path.isdir(_batch_dir(directory, batch_id))
+
+
+def export_snapshot(batch_id: str, forecast_time, records: Iterable[Mapping], directory: str = SNAPSHOT_DIR) -> None:
+    """
+    Export a batch as a columnar snapshot: one .npy file per column, sorted by (latitude, longitude)
+    so a point lookup is a binary search. Snapshots are immutable, an existing one is kept.
+    """
+    if has_snapshot(batch_id, directory):
+        return
+
+    records = list(records)
+    columns = {
+        name: np.array([record.get(name) for record in records], dtype=np.float64)
+        for name in COLUMNS
+    }
+    order = np.lexsort((columns["longitude"], columns["latitude"]))
+
+    # Write into a hidden directory and rename it into place, so readers never see a partial snapshot.
+    os.makedirs(directory, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=directory, prefix=".export-")
+    try:
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values[order])
+        with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+            json.dump({"batch_id": batch_id, "forecast_time": _utc(forecast_time).isoformat()}, f)
+        os.rename(tmp_dir, _batch_dir(directory, batch_id))
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not has_snapshot(batch_id, directory):  # Lost a race with another exporter otherwise
+            raise
+    logger.info(f"Exported snapshot for batch {batch_id}: {len(records)} records.")
+
+
+def publish_snapshots(batch_ids: List[str], directory: str = SNAPSHOT_DIR, aliases: Optional[Dict[str, str]] = None) -> None:
+    """
+    Atomically replace the manifest of served snapshots and prune snapshots no longer referenced.
+    `aliases` maps batches aliased to an identical batch onto the snapshot that serves them.
+    Snapshots referenced by the previous manifest are kept one more round for workers still loading it.
+    """
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    try:
+        with open(manifest_path) as f:
+            previous = json.load(f)["batches"]
+    except FileNotFoundError:
+        previous = []
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".manifest-")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"batches": batch_ids, "aliases": aliases or {}}, f)
+    os.replace(tmp_path, manifest_path)
+
+    keep = {quote(batch_id, safe="") for batch_id in batch_ids + previous}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not name.startswith(".") and name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    logger.info(f"Published snapshots for batches {batch_ids}.")
+
+
+class BatchSnapshot:
+    """A memory-mapped batch snapshot. Pages are shared through the OS page cache."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.batch_id = meta["batch_id"]
+        self.forecast_time = isoparse(meta["forecast_time"])
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns["latitude"])
+
+    def locate(self, latitude: float, longitude: float) -> slice:
+        """Binary search the (latitude, longitude) sort order for the rows at a point."""
+        latitudes = self.columns["latitude"]
+        lo = int(np.searchsorted(latitudes, latitude, side="left"))
+        hi = int(np.searchsorted(latitudes, latitude, side="right"))
+        longitudes = self.columns["longitude"][lo:hi]
+        return slice(
+            lo + int(np.searchsorted(longitudes, longitude, side="left")),
+            lo + int(np.searchsorted(longitudes, longitude, side="right")),
+        )
+
+    def region(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> np.ndarray:
+        """Binary search the latitude range of a bounding box, then mask its longitudes. Returns row indices."""
+        latitudes = self.columns["latitude"]
+        lo = int(np.searchsorted(latitudes, min_lat, side="left"))
+        hi = int(np.searchsorted(latitudes, max_lat, side="right"))
+        longitudes = self.columns["longitude"][lo:hi]
+        return lo + np.flatnonzero((longitudes >= min_lon) & (longitudes <= max_lon))
+
+
+class SnapshotStore:
+    """
+    Per-process view of the published snapshots.
+    The manifest is stat()ed on every read and the snapshot set reloaded when it changes.
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # (mtime, inode) of the loaded manifest, and of the last one that failed to load
+        self._manifest_version = None
+        self._failed_version = None
+        self._snapshots: Optional[List[BatchSnapshot]] = None
+        self._aliases: Dict[str, str] = {}
+        self._generation = None
+
+    def snapshots(self) -> Optional[List[BatchSnapshot]]:
+        """
+        Return the served snapshots ordered by forecast_time, or None if nothing is published.
+        A publish replaces the manifest file, so a new manifest has a new inode even within one mtime tick.
+        If the manifest can't be loaded, e.g. it lists a missing snapshot, the previously loaded set is kept
+        (None on first load, so reads use the database) until the next publish.
+        """
+        try:
+            stat = os.stat(os.path.join(self.directory, MANIFEST_FILE))
+        except FileNotFoundError:
+            return None
+
+        version = (stat.st_mtime_ns, stat.st_ino)
+        if version not in (self._manifest_version, self._failed_version):
+            with self._lock:
+                if version not in (self._manifest_version, self._failed_version):
+                    try:
+                        self._load(version)
+                    except Exception as e:
+                        self._failed_version = version
+                        logger.error(f"Error loading snapshot manifest, keeping the previous snapshots: {e}")
+        return self._snapshots
+
+    def _load(self, version) -> None:
+        """Map every snapshot of the manifest, then swap them in."""
+        mtime, _ = version
+        with open(os.path.join(self.directory, MANIFEST_FILE), "rb") as f:
+            content = f.read()
+        manifest = json.loads(content)
+        batch_ids = manifest["batches"]
+        snapshots = [BatchSnapshot(_batch_dir(self.directory, batch_id)) for batch_id in batch_ids]
+        self._snapshots = sorted(snapshots, key=lambda s: s.forecast_time)
+        self._aliases = manifest.get("aliases", {})
+        self._generation = (
+            hashlib.sha1(content).hexdigest(),
+            datetime.fromtimestamp(mtime // 10 ** 9, tz=timezone.utc),
+        )
+        self._manifest_version = version
+        logger.info(f"Loaded snapshots for batches {batch_ids}.")
+
+    def generation(self):
+        """
+        The validator of the loaded snapshot set, like fetch_data_generation: the manifest's content hash
+        and publish time. None if nothing is served.
+        """
+        if self.snapshots() is None:
+            return None
+        return self._generation
+
+    def _select(self, latitude, longitude, start=None, end=None, batch_id=None):
+        """Yield (snapshot, row slice) for each served snapshot matching the filters."""
+        start, end = _utc(start), _utc(end)
+        batch_id = self._aliases.get(batch_id, batch_id)
+        for snapshot in self.snapshots():
+            if batch_id is not None and snapshot.batch_id != batch_id:
+                continue
+            if (start is not None and snapshot.forecast_time < start) or (end is not None and snapshot.forecast_time > end):
+                continue
+            yield snapshot, snapshot.locate(latitude, longitude)
+
+    def resolve(self, batch_id: Optional[str] = None) -> Optional[str]:
+        """
+        The served snapshot for a batch, following aliases, or the latest one if no batch is given.
+        None if nothing is published or the batch is not served.
+        """
+        snapshots = self.snapshots()
+        if not snapshots:
+            return None
+        if batch_id is None:
+            return snapshots[-1].batch_id
+        batch_id = self._aliases.get(batch_id, batch_id)
+        return batch_id if any(s.batch_id == batch_id for s in snapshots) else None
+
+    def region(self, batch_id: str, metric: str, bbox) -> Optional[tuple]:
+        """Latitudes, longitudes and metric values of a served batch inside a bounding box, or None if it is not served."""
+        for snapshot in self.snapshots() or []:
+            if snapshot.batch_id == batch_id:
+                rows = snapshot.region(*bbox)
+                return snapshot.columns["latitude"][rows], snapshot.columns["longitude"][rows], snapshot.columns[metric][rows]
+        return None
+
+    def fetch(self, latitude: float, longitude: float, start=None, end=None, batch_id=None) -> Optional[List[WeatherRecord]]:
+        """Fetch the records at a point, or None if no snapshots are published."""
+        if self.snapshots() is None:
+            return None
+        records = []
+        for snapshot, rows in self._select(latitude, longitude, start, end, batch_id):
+            values = [snapshot.columns[name][rows] for name in COLUMNS]
+            for row in zip(*values):
+                row = [None if np.isnan(v) else float(v) for v in row]
+                records.append(WeatherRecord(row[0], row[1], snapshot.forecast_time, *row[2:]))
+        return records
+
+    def summarize(self, latitude: float, longitude: float, start=None, end=None, batch_id=None) -> Optional[WeatherSummary]:
+        """Compute max/min/avg per metric at a point, or None if no snapshots are published."""
+        if self.snapshots() is None:
+            return None
+        selected = list(self._select(latitude, longitude, start, end, batch_id))
+        stats = []
+        for metric in METRICS:
+            values = np.concatenate([s.columns[metric][rows] for s, rows in selected] or [np.empty(0)])
+            values = values[~np.isnan(values)]
+            if len(values):
+                stats += [float(values.max()), float(values.min()), float(values.mean())]
+            else:
+                stats += [None, None, None]
+        return WeatherSummary(*stats)
+
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,436 @@
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union
+
+import httpx
+from dateutil.parser import isoparse
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.exc import IntegrityError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from config import (BATCH_DATA_ENDPOINT, BATCH_SIZE, INGESTION_INTERVAL_SECONDS, TASK_LEASE_SECONDS,
+                    TASK_MAX_ATTEMPTS, TASK_POLL_INTERVAL_SECONDS)
+from server.database import SessionLocal, init_db
+from server.ingestion_service import (fetch_batches, fetch_total_pages, hash_batch, hash_page, perform_cleanup_tasks,
+                                      find_previous_batch, refresh_snapshots, store_batch_sketches, store_forecast_diffs)
+from server.models import BatchMetadata, IngestTask, WeatherData
+from server.profiling import stage
+
+logger = logging.getLogger(__name__)
+
+LEASE = timedelta(seconds=TASK_LEASE_SECONDS)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@stage("plan")
+async def plan_batches() -> int:
+    """
+    Enqueue one task per page for every provider batch not ingested yet.
+    Safe to run from several nodes: a batch already planned elsewhere is skipped.
+    Returns the number of batches planned.
+    """
+    batches = await fetch_batches()
+    planned = 0
+    for batch in sorted(batches, key=lambda x: isoparse(x["forecast_time"])):
+        batch_id = batch["batch_id"]
+        session = SessionLocal()
+        try:
+            if session.query(BatchMetadata).filter_by(batch_id=batch_id).first():
+                continue
+
+            forecast_time = isoparse(batch["forecast_time"])
+            total_pages = await fetch_total_pages(batch_id)
+            session.add(BatchMetadata(
+                batch_id=batch_id,
+                forecast_time=forecast_time,
+                status="RUNNING",
+                number_of_rows=0,
+                start_ingest_time=datetime.now(),
+            ))
+            session.add_all([
+                IngestTask(batch_id=batch_id, page=page, forecast_time=forecast_time, status="PENDING", attempts=0)
+                for page in range(total_pages)
+            ])
+            session.commit()
+            planned += 1
+            logger.info(f"Planned batch {batch_id}: {total_pages} page tasks.")
+        except IntegrityError:
+            session.rollback()
+            logger.info(f"Batch {batch_id} was planned by another planner.")
+        finally:
+            session.close()
+    return planned
+
+
+@stage("queue")
+def claim_task(worker_id: str) -> Optional[Dict[str, Union[str, int]]]:
+    """
+    Claim the oldest pending task, or a running one whose lease expired, with FOR UPDATE SKIP LOCKED
+    so concurrent workers never block on or claim the same task.
+    """
+    session = SessionLocal()
+    try:
+        while True:
+            task = session.query(IngestTask).filter(
+                or_(
+                    IngestTask.status == "PENDING",
+                    and_(IngestTask.status == "RUNNING", IngestTask.lease_expires_at < func.now()),
+                )
+            ).order_by(IngestTask.id).with_for_update(skip_locked=True).first()
+
+            if task is None:
+                session.rollback()
+                return None
+
+            if task.attempts >= TASK_MAX_ATTEMPTS:
+                # Its last worker died without reporting, and the task is out of attempts.
+                # The batch row is locked before its tasks, so let go of the task and take both in that order.
+                task_id, batch_id = task.id, task.batch_id
+                session.rollback()
+                lock_batch(session, batch_id)
+                task = session.query(IngestTask).filter(
+                    IngestTask.id == task_id,
+                    IngestTask.status == "RUNNING",
+                    IngestTask.lease_expires_at < func.now(),
+                ).with_for_update(skip_locked=True).first()
+                if task is not None:
+                    task.status = "FAILED"
+                    task.last_error = task.last_error or "Lease expired"
+                    fail_batch(session, batch_id)
+                session.commit()
+                continue
+
+            task.status = "RUNNING"
+            task.worker_id = worker_id
+            task.attempts += 1
+            task.lease_expires_at = func.now() + LEASE
+            task.heartbeat_at = func.now()
+            claimed = {
+                "id": task.id,
+                "batch_id": task.batch_id,
+                "page": task.page,
+                "forecast_time": task.forecast_time,
+                "attempts": task.attempts,
+            }
+            session.commit()
+            return claimed
+    finally:
+        session.close()
+
+
+class Heartbeat:
+    """Extend a task's lease from a background thread while the worker is busy with it."""
+
+    def __init__(self, task_id: int, worker_id: str, interval: float = TASK_LEASE_SECONDS / 3):
+        self.task_id = task_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            session = SessionLocal()
+            try:
+                extended = session.query(IngestTask).filter(
+                    IngestTask.id == self.task_id,
+                    IngestTask.worker_id == self.worker_id,
+                    IngestTask.status == "RUNNING",
+                ).update(
+                    {IngestTask.lease_expires_at: func.now() + LEASE, IngestTask.heartbeat_at: func.now()},
+                    synchronize_session=False,
+                )
+                session.commit()
+                if not extended:
+                    logger.warning(f"Lost the lease on task {self.task_id}.")
+                    return
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error extending the lease on task {self.task_id}: {e}")
+            finally:
+                session.close()
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential(min=2, max=10), retry=retry_if_exception_type(httpx.RequestError))
+async def fetch_batch_page(batch_id: str, page: int) -> List[Dict[str, Union[str, float]]]:
+    """Fetch one page of a batch. Errors propagate so the task is retried."""
+    async with httpx.AsyncClient() as client:
+        response = await client.get(BATCH_DATA_ENDPOINT.format(batch_id=batch_id), params={"page": page})
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+
+@stage("insert")
+def complete_task(task: Dict[str, Union[str, int]], worker_id: str, records: List[Dict[str, Union[str, float]]]) -> bool:
+    """
+    Insert a page's rows and mark its task DONE in one transaction, only if this worker still holds it.
+    A worker whose lease expired and was claimed again inserts nothing.
+    """
+    session = SessionLocal()
+    try:
+        # Marking the task first locks its row, so a worker re-claiming it skips it until we commit.
+        owned = session.query(IngestTask).filter(
+            IngestTask.id == task["id"],
+            IngestTask.worker_id == worker_id,
+            IngestTask.status == "RUNNING",
+        ).update({
+            IngestTask.status: "DONE",
+            IngestTask.page_hash: hash_page(records),
+            IngestTask.number_of_rows: len(records),
+            IngestTask.lease_expires_at: None,
+        }, synchronize_session=False)
+        if not owned:
+            session.rollback()
+            logger.warning(f"Task {task['id']} was claimed by another worker. Discarding page {task['page']} of batch {task['batch_id']}.")
+            return False
+
+        rows = [
+            {
+                "batch_id": task["batch_id"],
+                "latitude": record["latitude"],
+                "longitude": record["longitude"],
+                "forecast_time": task["forecast_time"],
+                "temperature": record.get("temperature"),
+                "precipitation_rate": record.get("precipitation_rate"),
+                "humidity": record.get("humidity"),
+            }
+            for record in records
+        ]
+        for i in range(0, len(rows), BATCH_SIZE):
+            session.bulk_insert_mappings(WeatherData, rows[i:i + BATCH_SIZE])
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def release_task(task: Dict[str, Union[str, int]], worker_id: str, error: Exception) -> None:
+    """Return a failed task to the queue, or fail it and its batch once it is out of attempts."""
+    session = SessionLocal()
+    try:
+        out_of_attempts = task["attempts"] >= TASK_MAX_ATTEMPTS
+        if out_of_attempts:
+            lock_batch(session, task["batch_id"])
+        released = session.query(IngestTask).filter(
+            IngestTask.id == task["id"],
+            IngestTask.worker_id == worker_id,
+            IngestTask.status == "RUNNING",
+        ).update({
+            IngestTask.status: "FAILED" if out_of_attempts else "PENDING",
+            IngestTask.last_error: str(error),
+            IngestTask.lease_expires_at: None,
+        }, synchronize_session=False)
+        if released and out_of_attempts:
+            fail_batch(session, task["batch_id"])
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error releasing task {task['id']}: {e}")
+    finally:
+        session.close()
+
+
+def lock_batch(session, batch_id: str) -> None:
+    """
+    Lock a batch's metadata row. A transaction touching several tasks of a batch locks the batch first,
+    so workers failing pages of the same batch at once queue on it instead of deadlocking on each other's tasks.
+    """
+    session.query(BatchMetadata.batch_id).filter(BatchMetadata.batch_id == batch_id).with_for_update().first()
+
+
+def fail_batch(session, batch_id: str) -> None:
+    """
+    Mark a batch FAILED, cancel its remaining tasks and delete the pages already stored, which readers
+    would otherwise see as a partial batch. The caller holds the batch lock (lock_batch) before any task lock.
+    """
+    session.query(BatchMetadata).filter(BatchMetadata.batch_id == batch_id).update(
+        {BatchMetadata.status: "FAILED"}, synchronize_session=False
+    )
+    # Failing running tasks waits for pages being committed and makes later completions discard their page,
+    # so the delete below sees every stored page.
+    session.query(IngestTask).filter(
+        IngestTask.batch_id == batch_id,
+        IngestTask.status.in_(["PENDING", "RUNNING"]),
+    ).update({IngestTask.status: "FAILED"}, synchronize_session=False)
+    session.query(WeatherData).filter(WeatherData.batch_id == batch_id).delete(synchronize_session=False)
+    logger.error(f"Batch {batch_id} failed.")
+
+
+@stage("finalize")
+def finalize_batch(batch_id: str) -> bool:
+    """
+    Mark a batch ACTIVE once all of its page tasks are DONE.
+    The batch row is locked so exactly one of the workers finishing its last pages finalizes it.
+    """
+    session = SessionLocal()
+    try:
+        metadata = session.query(BatchMetadata).filter(
+            BatchMetadata.batch_id == batch_id
+        ).with_for_update().first()
+        if metadata is None or metadata.status != "RUNNING":
+            session.rollback()
+            return False
+
+        tasks = session.query(IngestTask).filter(IngestTask.batch_id == batch_id).order_by(IngestTask.page).all()
+        if any(task.status != "DONE" for task in tasks):
+            session.rollback()
+            return False
+
+        store_batch_sketches(session, batch_id)
+        previous = find_previous_batch(session, metadata)
+        if previous is not None:
+            store_forecast_diffs(session, batch_id, previous.batch_id)
+        metadata.page_hashes = [task.page_hash for task in tasks]
+        metadata.content_hash = hash_batch(metadata.page_hashes)
+        metadata.number_of_rows = sum(task.number_of_rows for task in tasks)
+        metadata.status = "ACTIVE"
+        metadata.end_ingest_time = datetime.now()
+        session.commit()
+        logger.info(f"Batch {batch_id} ingested successfully: {metadata.number_of_rows} rows from {len(tasks)} pages.")
+        return True
+    finally:
+        session.close()
+
+
+@stage("finalize")
+def finalize_stalled_batches() -> int:
+    """
+    Finalize RUNNING batches whose page tasks are all DONE. The worker storing a batch's last page finalizes it,
+    but if that worker dies or finalizing fails after the page is committed, nothing else would.
+    Returns the number of batches finalized.
+    """
+    session = SessionLocal()
+    try:
+        batch_ids = [row.batch_id for row in session.query(BatchMetadata.batch_id).filter(
+            BatchMetadata.status == "RUNNING",
+            exists().where(IngestTask.batch_id == BatchMetadata.batch_id),
+            ~exists().where(IngestTask.batch_id == BatchMetadata.batch_id, IngestTask.status != "DONE"),
+        ).all()]
+    finally:
+        session.close()
+
+    finalized = 0
+    for batch_id in batch_ids:
+        try:
+            finalized += finalize_batch(batch_id)
+        except Exception as e:
+            logger.error(f"Error finalizing batch {batch_id}: {e}")
+    return finalized
+
+
+async def run_task(task: Dict[str, Union[str, int]], worker_id: str) -> None:
+    """Fetch and store one page, then finalize its batch if it was the last one."""
+    start_time = time.perf_counter()
+    try:
+        with Heartbeat(task["id"], worker_id):
+            records = await fetch_batch_page(task["batch_id"], task["page"])
+            completed = complete_task(task, worker_id, records)
+    except Exception as e:
+        logger.error(f"Error processing page {task['page']} of batch {task['batch_id']} (attempt {task['attempts']}): {e}")
+        release_task(task, worker_id, e)
+        return
+
+    if completed:
+        logger.info(f"Ingested page {task['page']} of batch {task['batch_id']}: "
+                    f"{len(records)} records in {time.perf_counter() - start_time:.2f} seconds.")
+        # Snapshots are exported and published by the planner only: publishing prunes the snapshots missing
+        # from the publisher's manifest, so concurrent publishers could delete each other's snapshots.
+        try:
+            finalize_batch(task["batch_id"])
+        except Exception as e:
+            # The planner's sweep finalizes it later.
+            logger.error(f"Error finalizing batch {task['batch_id']}: {e}")
+
+
+async def run_worker(worker_id: str, drain: bool = False) -> None:
+    """Claim and run tasks until stopped, or until the queue is empty when draining."""
+    logger.info(f"Worker {worker_id} started.")
+    while True:
+        try:
+            task = claim_task(worker_id)
+        except Exception as e:
+            # A transient database error must not kill the worker: its claim was rolled back, poll again.
+            logger.error(f"Error claiming a task in worker {worker_id}: {e}")
+            await asyncio.sleep(TASK_POLL_INTERVAL_SECONDS)
+            continue
+        if task is None:
+            if drain:
+                logger.info(f"Worker {worker_id} drained the queue.")
+                return
+            await asyncio.sleep(TASK_POLL_INTERVAL_SECONDS)
+            continue
+        try:
+            await run_task(task, worker_id)
+        except Exception as e:
+            # The task's lease expires and it is claimed again.
+            logger.error(f"Error running task {task['id']} in worker {worker_id}: {e}")
+
+
+async def run_planner(once: bool = False) -> None:
+    """Plan new batches, finalize stalled ones, run cleanup and publish snapshots, every ingestion interval."""
+    while True:
+        try:
+            await plan_batches()
+            finalize_stalled_batches()
+            perform_cleanup_tasks()
+            refresh_snapshots()
+        except Exception as e:
+            logger.error(f"Error in the ingestion planner: {e}")
+        if once:
+            return
+        await asyncio.sleep(INGESTION_INTERVAL_SECONDS)
+
+
+def queue_stats() -> Dict[str, int]:
+    """Number of tasks per status."""
+    session = SessionLocal()
+    try:
+        return dict(session.query(IngestTask.status, func.count(IngestTask.id)).group_by(IngestTask.status).all())
+    finally:
+        session.close()
+
+
+def main() -> None:
+    """Run the distributed ingestion planner or a worker."""
+    parser = argparse.ArgumentParser(description="Distributed weather ingestion over a Postgres work queue.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    plan_parser = subparsers.add_parser("plan", help="Enqueue page tasks for new batches and run cleanup.")
+    plan_parser.add_argument("--once", action="store_true", help="Plan a single time and exit.")
+    work_parser = subparsers.add_parser("work", help="Claim and ingest page tasks.")
+    work_parser.add_argument("--drain", action="store_true", help="Exit once the queue is empty.")
+    work_parser.add_argument("--worker-id", default=default_worker_id())
+    subparsers.add_parser("stats", help="Print the number of tasks per status.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.command == "plan":
+        init_db()
+        asyncio.run(run_planner(args.once))
+    elif args.command == "work":
+        asyncio.run(run_worker(args.worker_id, args.drain))
+    else:
+        print(queue_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import logging
+import math
+import struct
+import zlib
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from config import COMPRESSION_LEVEL, RASTER_GRID_PADDING_CELLS, RASTER_GRID_STEP, TILE_CACHE_SIZE, TILE_SIZE
+from server.database import SessionLocal
+from server.models import BatchMetadata
+from server.profiling import timed
+from server.snapshots import snapshot_store, snapshots_enabled
+from server.utils import bbox_filters, effective_weather_data
+
+logger = logging.getLogger(__name__)
+
+# Values mapped onto the 0-255 gray levels of PNG rasters when the request has no vmin/vmax
+DEFAULT_VALUE_RANGES = {
+    "temperature": (-40.0, 120.0),
+    "precipitation_rate": (0.0, 10.0),
+    "humidity": (0.0, 100.0),
+}
+FORMATS = {"png": "image/png", "f32": "application/octet-stream"}
+MAX_ZOOM = 22
+
+# A raster: the encoded body, its mimetype and the headers describing it
+Raster = namedtuple("Raster", ["body", "mimetype", "headers"])
+
+# Grid step of recently rendered batches, measured from their points. A batch's grid never changes.
+_grid_steps: "OrderedDict[str, float]" = OrderedDict()
+GRID_STEP_CACHE_SIZE = 64
+
+
+def tile_latitude(y: float, zoom: int) -> float:
+    """Latitude of a (fractional) Web Mercator tile row."""
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2 ** zoom))))
+
+
+def tile_longitude(x: float, zoom: int) -> float:
+    """Longitude of a (fractional) Web Mercator tile column."""
+    return x / 2 ** zoom * 360.0 - 180.0
+
+
+def tile_bbox(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Bounding box (min_lon, min_lat, max_lon, max_lat) of a Web Mercator tile."""
+    return tile_longitude(x, zoom), tile_latitude(y + 1, zoom), tile_longitude(x + 1, zoom), tile_latitude(y, zoom)
+
+
+def tile_pixel_centers(zoom: int, x: int, y: int, size: int = TILE_SIZE):
+    """Latitudes of the pixel rows (top to bottom) and longitudes of the pixel columns of a tile."""
+    offsets = (np.arange(size) + 0.5) / size
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / 2 ** zoom))))
+    longitudes = (x + offsets) / 2 ** zoom * 360.0 - 180.0
+    return latitudes, longitudes
+
+
+def pad_bbox(bbox, padding: float) -> Tuple[float, float, float, float]:
+    """Grow a bounding box by `padding` degrees on each side."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return min_lon - padding, min_lat - padding, max_lon + padding, max_lat + padding
+
+
+def grid_step(latitudes, longitudes) -> Optional[float]:
+    """The grid step of gridded points: the larger median spacing of their latitudes and longitudes. None for fewer than two."""
+    steps = [float(np.median(np.diff(np.unique(coordinates)))) for coordinates in (latitudes, longitudes)
+             if len(np.unique(coordinates)) > 1]
+    return max(steps) if steps else None
+
+
+def bbox_pixel_centers(bbox, width: int, height: int):
+    """Latitudes of the pixel rows (top to bottom) and longitudes of the pixel columns of a lat/lon raster."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    latitudes = max_lat - (np.arange(height) + 0.5) * (max_lat - min_lat) / height
+    longitudes = min_lon + (np.arange(width) + 0.5) * (max_lon - min_lon) / width
+    return latitudes, longitudes
+
+
+def nearest_grid_index(grid: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest grid coordinate for each target, or -1 for targets further than half a grid step
+    (or half a pixel, when pixels are coarser than the grid) from every coordinate.
+    """
+    if len(grid) == 0:
+        return np.full(len(targets), -1)
+    right = np.clip(np.searchsorted(grid, targets), 0, len(grid) - 1)
+    left = np.maximum(right - 1, 0)
+    index = np.where(np.abs(targets - grid[left]) <= np.abs(grid[right] - targets), left, right)
+
+    grid_step = float(np.median(np.diff(grid))) if len(grid) > 1 else 0.0
+    pixel_step = np.abs(np.gradient(targets)) if len(targets) > 1 else np.zeros(len(targets))
+    tolerance = np.maximum(grid_step, pixel_step) / 2
+    return np.where(np.abs(targets - grid[index]) <= tolerance, index, -1)
+
+
+def rasterize(latitudes, longitudes, values, pixel_latitudes, pixel_longitudes) -> np.ndarray:
+    """
+    Nearest-grid rasterization of gridded points: the points are placed on their (latitude, longitude) grid
+    and every pixel takes the value of the grid cell nearest to its center. Pixels without data are NaN.
+    """
+    grid_latitudes, lat_index = np.unique(latitudes, return_inverse=True)
+    grid_longitudes, lon_index = np.unique(longitudes, return_inverse=True)
+    grid = np.full((len(grid_latitudes) + 1, len(grid_longitudes) + 1), np.nan, dtype=np.float32)
+    grid[lat_index, lon_index] = values
+
+    # Index -1 picks the extra all-NaN row or column
+    rows = nearest_grid_index(grid_latitudes, pixel_latitudes)
+    columns = nearest_grid_index(grid_longitudes, pixel_longitudes)
+    return grid[rows[:, None], columns[None, :]]
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_png(raster: np.ndarray, vmin: float, vmax: float) -> bytes:
+    """
+    Encode a raster as an 8-bit gray + alpha PNG: values are scaled linearly from [vmin, vmax] to 0-255
+    and pixels without data are transparent.
+    """
+    height, width = raster.shape
+    missing = np.isnan(raster)
+    scaled = np.clip((np.where(missing, vmin, raster) - vmin) / (vmax - vmin), 0, 1)
+    pixels = np.empty((height, width, 2), dtype=np.uint8)
+    pixels[..., 0] = np.rint(scaled * 255)
+    pixels[..., 1] = np.where(missing, 0, 255)
+    # Each scanline starts with its filter type, 0 (none)
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels.reshape(height, width * 2)])
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 4, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), COMPRESSION_LEVEL)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+def encode_raster(raster: np.ndarray, bbox, batch_id: str, fmt: str, vmin: float, vmax: float) -> Raster:
+    """Encode a raster as PNG or as row-major little-endian float32 with NaN for missing pixels."""
+    height, width = raster.shape
+    headers = {
+        "X-Batch-Id": batch_id,
+        "X-Raster-Size": f"{width},{height}",
+        "X-Raster-Bbox": ",".join(f"{v:.6f}" for v in bbox),
+    }
+    if fmt == "png":
+        headers["X-Value-Range"] = f"{vmin},{vmax}"
+        body = encode_png(raster, vmin, vmax)
+    else:
+        body = raster.astype("<f4").tobytes()
+    return Raster(body, FORMATS[fmt], headers)
+
+
+def resolve_raster_batch(batch_id: Optional[str] = None) -> Optional[str]:
+    """
+    The batch whose rows serve a raster: the given active batch, or the latest active one, with aliases
+    resolved. None if there is no such active batch.
+    """
+    if snapshots_enabled():
+        served = snapshot_store.resolve(batch_id)
+        if served is not None:
+            return served
+
+    session = SessionLocal()
+    try:
+        query = session.query(BatchMetadata.batch_id, BatchMetadata.alias_of).filter(BatchMetadata.status == "ACTIVE")
+        if batch_id is not None:
+            row = query.filter(BatchMetadata.batch_id == batch_id).first()
+        else:
+            row = query.order_by(BatchMetadata.forecast_time.desc()).first()
+        return None if row is None else row.alias_of or row.batch_id
+    except Exception as e:
+        logger.error(f"Error resolving raster batch: {e}")
+        raise
+    finally:
+        session.close()
+
+
+def fetch_region(batch_id: str, metric: str, bbox):
+    """
+    Fetch the latitudes, longitudes and metric values of a batch inside a bounding box, with a single
+    range query on ix_weather_lat_lon_time, or from the batch snapshot when it is served.
+    """
+    if snapshots_enabled():
+        region = snapshot_store.region(batch_id, metric, bbox)
+        if region is not None:
+            return region
+
+    session = SessionLocal()
+    try:
+        weather = effective_weather_data(bbox_filters(*bbox), batch_id=batch_id)
+        rows = session.execute(select(weather.c.latitude, weather.c.longitude, weather.c[metric])).all()
+    except Exception as e:
+        logger.error(f"Error fetching raster region: {e}")
+        raise
+    finally:
+        session.close()
+
+    columns = np.array(rows, dtype=np.float64).reshape(len(rows), 3)
+    return columns[:, 0], columns[:, 1], columns[:, 2]
+
+
+def value_range(metric: str, vmin: Optional[float] = None, vmax: Optional[float] = None) -> Tuple[float, float]:
+    """The requested PNG value range, defaulting to the metric's usual range."""
+    default_vmin, default_vmax = DEFAULT_VALUE_RANGES[metric]
+    return default_vmin if vmin is None else vmin, default_vmax if vmax is None else vmax
+
+
+def render_raster(batch_id: str, metric: str, bbox, pixel_latitudes, pixel_longitudes, fmt: str, vmin: float, vmax: float) -> Raster:
+    """
+    Fetch, rasterize and encode one raster. Points are fetched RASTER_GRID_PADDING_CELLS grid cells around the
+    bbox too: the nearest grid point of a pixel near an edge may lie outside, and a tile smaller than a grid cell
+    may contain no point at all. The batch's grid step is measured from the first fetch, which is repeated if the
+    assumed step was too small.
+    """
+    step = _grid_steps.get(batch_id, RASTER_GRID_STEP)
+    latitudes, longitudes, values = fetch_region(batch_id, metric, pad_bbox(bbox, step * RASTER_GRID_PADDING_CELLS))
+    if batch_id not in _grid_steps:
+        measured = grid_step(latitudes, longitudes)
+        if measured is not None:
+            _grid_steps[batch_id] = measured
+            if len(_grid_steps) > GRID_STEP_CACHE_SIZE:
+                _grid_steps.popitem(last=False)
+            if measured > step:
+                latitudes, longitudes, values = fetch_region(batch_id, metric, pad_bbox(bbox, measured * RASTER_GRID_PADDING_CELLS))
+    with timed("rasterize"):
+        raster = rasterize(latitudes, longitudes, values, pixel_latitudes, pixel_longitudes)
+    with timed("encode"):
+        return encode_raster(raster, bbox, batch_id, fmt, vmin, vmax)
+
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def _render_tile(batch_id: str, metric: str, zoom: int, x: int, y: int, fmt: str, vmin: float, vmax: float) -> Raster:
+    """Tiles are cached per batch: the rows of an active batch never change."""
+    pixel_latitudes, pixel_longitudes = tile_pixel_centers(zoom, x, y)
+    return render_raster(batch_id, metric, tile_bbox(zoom, x, y), pixel_latitudes, pixel_longitudes, fmt, vmin, vmax)
+
+
+def render_tile(metric: str, zoom: int, x: int, y: int, batch_id: Optional[str] = None,
+                fmt: str = "png", vmin: Optional[float] = None, vmax: Optional[float] = None) -> Optional[Raster]:
+    """Render a Web Mercator tile of a metric, or None if there is no matching active batch."""
+    batch_id = resolve_raster_batch(batch_id)
+    if batch_id is None:
+        return None
+    return _render_tile(batch_id, metric, zoom, x, y, fmt, *value_range(metric, vmin, vmax))
+
+
+def render_bbox(metric: str, bbox, width: int, height: int, batch_id: Optional[str] = None,
+                fmt: str = "png", vmin: Optional[float] = None, vmax: Optional[float] = None) -> Optional[Raster]:
+    """Render a metric over a lat/lon bounding box, or None if there is no matching active batch. Not cached."""
+    batch_id = resolve_raster_batch(batch_id)
+    if batch_id is None:
+        return None
+    pixel_latitudes, pixel_longitudes = bbox_pixel_centers(bbox, width, height)
+    return render_raster(batch_id, metric, bbox, pixel_latitudes, pixel_longitudes, fmt, *value_range(metric, vmin, vmax))
@@ -1,42 +1,159 @@
+import hashlib
 import logging
+from sqlalchemy import exists, select, union_all
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import func
 from server.database import SessionLocal
-from server.models import WeatherData, BatchMetadata
+from server.forecast_diffs import top_changes
+from server.models import ForecastDiff, WeatherData, BatchMetadata, WeatherSketch
+from server.sketches import Sketch, cell_index, merge_sketches
+from server.snapshots import METRICS, snapshot_store, snapshots_enabled
 
 logger = logging.getLogger(__name__)
 
-def fetch_weather_data(latitude: float, longitude: float):
+# Columns stored in ix_weather_lat_lon_time (key + INCLUDE), so queries that
+# select only these can be served by an index-only scan.
+WEATHER_DATA_COLUMNS = (
+    "latitude",
+    "longitude",
+    "forecast_time",
+    "temperature",
+    "precipitation_rate",
+    "humidity",
+)
+# Rows streamed per round trip when ranking the changes of a bbox in memory
+TOP_CHANGES_FETCH_SIZE = 1000
+
+
+def utc_timestamp(naive_utc):
+    """
+    Read a naive UTC timestamp, such as batch_metadata.forecast_time, as timestamptz. A plain cast would
+    interpret it in the session TimeZone.
+    """
+    return func.timezone("UTC", naive_utc)
+
+
+def point_filters(latitude: float, longitude: float):
+    """
+    Location filter for a single grid point, applied to whichever weather_data alias is passed in.
+    """
+    return lambda table: [table.latitude == latitude, table.longitude == longitude]
+
+def bbox_filters(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    """
+    Location filter for a bounding box: a latitude range on the leading column of ix_weather_lat_lon_time,
+    with the longitude range checked on the index entries.
+    """
+    return lambda table: [table.latitude.between(min_lat, max_lat), table.longitude.between(min_lon, max_lon)]
+
+def effective_weather_data(location_filters, start=None, end=None, batch_id=None):
+    """
+    Build a subquery of the weather rows of every batch, as readers should see them.
+
+    Rows stored under a batch are returned as is. An active delta batch only stores the points that
+    changed versus its delta_base, so the base rows it does not override are returned in its name.
+    Only columns covered by ix_weather_lat_lon_time are read, so both branches are index-only.
+    """
+    stored = aliased(WeatherData)
+    base = aliased(WeatherData)
+    override = aliased(WeatherData)
+    delta_forecast_time = utc_timestamp(BatchMetadata.forecast_time)
+
+    stored_rows = select(
+        stored.batch_id, *(getattr(stored, column) for column in WEATHER_DATA_COLUMNS)
+    ).where(*location_filters(stored))
+
+    inherited_rows = select(
+        BatchMetadata.batch_id,
+        base.latitude,
+        base.longitude,
+        delta_forecast_time.label("forecast_time"),
+        base.temperature,
+        base.precipitation_rate,
+        base.humidity,
+    ).join(
+        BatchMetadata, BatchMetadata.delta_base == base.batch_id
+    ).where(
+        BatchMetadata.status == "ACTIVE",
+        *location_filters(base),
+        ~exists().where(
+            override.batch_id == BatchMetadata.batch_id,
+            override.latitude == base.latitude,
+            override.longitude == base.longitude,
+        ),
+    )
+
+    if start is not None:
+        stored_rows = stored_rows.where(stored.forecast_time >= start)
+        inherited_rows = inherited_rows.where(delta_forecast_time >= start)
+    if end is not None:
+        stored_rows = stored_rows.where(stored.forecast_time <= end)
+        inherited_rows = inherited_rows.where(delta_forecast_time <= end)
+    if batch_id is not None:
+        stored_rows = stored_rows.where(stored.batch_id == batch_id)
+        inherited_rows = inherited_rows.where(BatchMetadata.batch_id == batch_id)
+
+    return union_all(stored_rows, inherited_rows).subquery("weather")
+
+def resolve_batch_id(session, batch_id):
     """
-    Fetch weather data based on latitude and longitude.
+    Resolve an aliased batch to the batch whose rows it shares.
     """
+    if batch_id is None:
+        return None
+    alias_of = session.query(BatchMetadata.alias_of).filter(BatchMetadata.batch_id == batch_id).scalar()
+    return alias_of or batch_id
+
+def build_weather_data_query(latitude: float, longitude: float, start=None, end=None, batch_id=None):
+    """
+    Build the weather data query, selecting only covered columns instead of ORM entities.
+    """
+    weather = effective_weather_data(point_filters(latitude, longitude), start, end, batch_id)
+    return select(*(weather.c[column] for column in WEATHER_DATA_COLUMNS)).order_by(weather.c.forecast_time)
+
+def fetch_weather_data(latitude: float, longitude: float, start=None, end=None, batch_id=None):
+    """
+    Fetch weather data based on latitude and longitude, optionally bounded by forecast_time and batch.
+    Served from the active batch snapshots when snapshot mode is enabled and a snapshot set is published.
+    """
+    if snapshots_enabled():
+        records = snapshot_store.fetch(latitude, longitude, start, end, batch_id)
+        if records is not None:
+            return records
+
     session = SessionLocal()
     try:
-        return session.query(WeatherData).filter_by(latitude=latitude, longitude=longitude).all()
+        batch_id = resolve_batch_id(session, batch_id)
+        return session.execute(build_weather_data_query(latitude, longitude, start, end, batch_id)).all()
     except Exception as e:
         logger.error(f"Error fetching weather data: {e}")
         raise
     finally:
         session.close()
 
-def summarize_weather_data(latitude: float, longitude: float):
+def summarize_weather_data(latitude: float, longitude: float, start=None, end=None, batch_id=None):
     """
     Summarize weather data statistics.
     """
+    if snapshots_enabled():
+        summary = snapshot_store.summarize(latitude, longitude, start, end, batch_id)
+        if summary is not None:
+            return summary
+
     session = SessionLocal()
     try:
+        batch_id = resolve_batch_id(session, batch_id)
+        weather = effective_weather_data(point_filters(latitude, longitude), start, end, batch_id)
         return session.query(
-            func.max(WeatherData.temperature).label("max_temperature"),
-            func.min(WeatherData.temperature).label("min_temperature"),
-            func.avg(WeatherData.temperature).label("avg_temperature"),
-            func.max(WeatherData.precipitation_rate).label("max_precipitation_rate"),
-            func.min(WeatherData.precipitation_rate).label("min_precipitation_rate"),
-            func.avg(WeatherData.precipitation_rate).label("avg_precipitation_rate"),
-            func.max(WeatherData.humidity).label("max_humidity"),
-            func.min(WeatherData.humidity).label("min_humidity"),
-            func.avg(WeatherData.humidity).label("avg_humidity"),
-        ).filter(
-            WeatherData.latitude == latitude,
-            WeatherData.longitude == longitude
+            func.max(weather.c.temperature).label("max_temperature"),
+            func.min(weather.c.temperature).label("min_temperature"),
+            func.avg(weather.c.temperature).label("avg_temperature"),
+            func.max(weather.c.precipitation_rate).label("max_precipitation_rate"),
+            func.min(weather.c.precipitation_rate).label("min_precipitation_rate"),
+            func.avg(weather.c.precipitation_rate).label("avg_precipitation_rate"),
+            func.max(weather.c.humidity).label("max_humidity"),
+            func.min(weather.c.humidity).label("min_humidity"),
+            func.avg(weather.c.humidity).label("avg_humidity"),
         ).one()
     except Exception as e:
         logger.error(f"Error summarizing weather data: {e}")
@@ -44,6 +161,135 @@ def summarize_weather_data(latitude: float, longitude: float):
     finally:
         session.close()
 
+def fetch_point_sketches(latitude: float, longitude: float, start=None, end=None, batch_id=None):
+    """
+    Build a sketch per metric from the few rows stored at a point, one per batch, for percentiles and histograms.
+    The values are kept, so percentiles at a point are exact.
+    """
+    records = fetch_weather_data(latitude, longitude, start, end, batch_id)
+    return {
+        metric: Sketch.from_values(metric, (getattr(r, metric) for r in records), keep_values=True)
+        for metric in METRICS
+    }
+
+def fetch_region_sketches(bbox, start=None, end=None, batch_id=None):
+    """
+    Merge the sketches of the cells overlapping a bounding box (min_lon, min_lat, max_lon, max_lat), over the
+    active batches or the given one. The cost depends on the number of cells, not on the number of rows.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    session = SessionLocal()
+    try:
+        batch_forecast_time = utc_timestamp(BatchMetadata.forecast_time)
+        batches = select(BatchMetadata.batch_id)
+        if batch_id is not None:
+            batches = batches.where(BatchMetadata.batch_id == resolve_batch_id(session, batch_id))
+        else:
+            # Aliases share the sketches of their original batch, so they are counted once.
+            batches = batches.where(BatchMetadata.status == "ACTIVE", BatchMetadata.alias_of.is_(None))
+        if start is not None:
+            batches = batches.where(batch_forecast_time >= start)
+        if end is not None:
+            batches = batches.where(batch_forecast_time <= end)
+
+        rows = session.query(
+            WeatherSketch.metric,
+            WeatherSketch.minimum,
+            WeatherSketch.maximum,
+            WeatherSketch.total,
+            WeatherSketch.bins,
+        ).filter(
+            WeatherSketch.batch_id.in_(batches),
+            WeatherSketch.cell_lat.between(cell_index(min_lat), cell_index(max_lat)),
+            WeatherSketch.cell_lon.between(cell_index(min_lon), cell_index(max_lon)),
+        ).all()
+        return merge_sketches(rows)
+    except Exception as e:
+        logger.error(f"Error fetching region sketches: {e}")
+        raise
+    finally:
+        session.close()
+
+def fetch_point_changes(latitude: float, longitude: float):
+    """
+    Fetch the forecast changes at a point between each pair of consecutive active batches, oldest first.
+    """
+    session = SessionLocal()
+    try:
+        current = aliased(BatchMetadata)
+        previous = aliased(BatchMetadata)
+        return session.query(
+            ForecastDiff.batch_id,
+            current.forecast_time,
+            ForecastDiff.previous_batch_id,
+            previous.forecast_time.label("previous_forecast_time"),
+            *(getattr(ForecastDiff, metric) for metric in METRICS),
+        ).join(
+            current, current.batch_id == ForecastDiff.batch_id
+        ).join(
+            previous, previous.batch_id == ForecastDiff.previous_batch_id
+        ).filter(
+            ForecastDiff.latitude == latitude,
+            ForecastDiff.longitude == longitude,
+            current.status == "ACTIVE",
+            previous.status == "ACTIVE",
+        ).order_by(current.forecast_time, current.batch_id).all()
+    except Exception as e:
+        logger.error(f"Error fetching point changes: {e}")
+        raise
+    finally:
+        session.close()
+
+def fetch_top_changes(metric: str, bbox=None, limit: int = 10, batch_id=None):
+    """
+    Fetch the points of a bounding box whose metric changed the most between a batch (the latest active one
+    by default) and the active batch before it, largest absolute change first. The ranking of a whole batch
+    is read in order from its ix_forecast_diffs_<metric> index. A bbox is read through the primary key's
+    latitude and longitude prefix instead and ranked in memory, since walking the ranking until N rows fall
+    inside a small bbox can scan most of the batch.
+    Returns (batch_id, previous_batch_id, rows), or None if the batch is not active or has no previous batch.
+    """
+    session = SessionLocal()
+    try:
+        batches = session.query(BatchMetadata.batch_id, BatchMetadata.alias_of).filter(BatchMetadata.status == "ACTIVE")
+        if batch_id is not None:
+            batch = batches.filter(BatchMetadata.batch_id == batch_id).first()
+        else:
+            batch = batches.order_by(BatchMetadata.forecast_time.desc(), BatchMetadata.batch_id.desc()).first()
+        if batch is None:
+            return None
+        batch_id = batch.alias_of or batch.batch_id
+
+        previous_batch_id = session.query(ForecastDiff.previous_batch_id).filter(
+            ForecastDiff.batch_id == batch_id
+        ).limit(1).scalar()
+        if previous_batch_id is None:
+            return None
+
+        change = getattr(ForecastDiff, metric)
+        query = session.query(
+            ForecastDiff.latitude, ForecastDiff.longitude, change.label("change")
+        ).filter(ForecastDiff.batch_id == batch_id, change.isnot(None))
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            query = query.filter(*bbox_filters(min_lon, min_lat, max_lon, max_lat)(ForecastDiff))
+            rows = top_changes(query.yield_per(TOP_CHANGES_FETCH_SIZE), limit)
+        else:
+            rows = query.order_by(func.abs(change).desc().nullslast()).limit(limit).all()
+        return batch_id, previous_batch_id, rows
+    except Exception as e:
+        logger.error(f"Error fetching top changes: {e}")
+        raise
+    finally:
+        session.close()
+
+def fetch_batch_records(session, batch_id):
+    """
+    Fetch every row of a batch as readers see it, following aliases and delta bases.
+    """
+    weather = effective_weather_data(lambda table: [], batch_id=resolve_batch_id(session, batch_id))
+    return session.execute(select(*(weather.c[column] for column in WEATHER_DATA_COLUMNS))).all()
+
 def fetch_batches():
     """
     Fetch all batches from the database.
@@ -90,3 +336,32 @@ def format_weather_summary(summary):
             "avg": summary.avg_humidity,
         },
     }
+
+def fetch_data_generation():
+    """
+    Fetch a fingerprint of the batch set and the time it last changed.
+    The fingerprint changes whenever a batch starts, finishes, fails or is retired,
+    so it can be used as a validator for every GET endpoint.
+    """
+    session = SessionLocal()
+    try:
+        rows = session.query(
+            BatchMetadata.status,
+            BatchMetadata.retained,
+            func.count(BatchMetadata.batch_id),
+            func.max(BatchMetadata.start_ingest_time),
+            func.max(BatchMetadata.end_ingest_time),
+        ).group_by(
+            BatchMetadata.status, BatchMetadata.retained
+        ).order_by(
+            BatchMetadata.status, BatchMetadata.retained
+        ).all()
+    except Exception as e:
+        logger.error(f"Error fetching data generation: {e}")
+        raise
+    finally:
+        session.close()
+
+    generation = hashlib.sha1(repr([tuple(row) for row in rows]).encode()).hexdigest()
+    timestamps = [t for row in rows for t in (row[3], row[4]) if t is not None]
+    return generation, max(timestamps, default=None)
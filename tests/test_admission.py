@@ -0,0 +1,78 @@
+import threading
+import time
+from flask import Flask
+from unittest.mock import patch
+
+from server.admission import AdmissionController, admit, check_pool_capacity
+
+
+class TestAdmissionController:
+    """Tests for per-budget concurrency limits and load shedding."""
+
+    def test_admits_up_to_limit(self):
+        """Test that requests beyond the limit are shed when the queue is disabled."""
+        controller = AdmissionController("test", max_in_flight=2, max_queue=0, queue_timeout=0)
+        assert controller.acquire()
+        assert controller.acquire()
+        assert not controller.acquire()
+        assert controller.stats()["shed_queue_full_total"] == 1
+
+        controller.release()
+        assert controller.acquire()
+
+    def test_queue_timeout(self):
+        """Test that a queued request is shed once the wait times out."""
+        controller = AdmissionController("test", max_in_flight=1, max_queue=1, queue_timeout=0.01)
+        assert controller.acquire()
+        assert not controller.acquire()
+        stats = controller.stats()
+        assert stats["queued_total"] == 1
+        assert stats["shed_timeout_total"] == 1
+        assert stats["queued"] == 0
+
+    def test_queued_request_admitted_on_release(self):
+        """Test that a release wakes up a waiting request."""
+        controller = AdmissionController("test", max_in_flight=1, max_queue=1, queue_timeout=5)
+        assert controller.acquire()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(controller.acquire()))
+        waiter.start()
+        while controller.stats()["queued"] == 0:
+            time.sleep(0.001)
+        controller.release()
+        waiter.join()
+        assert result == [True]
+        assert controller.stats()["in_flight"] == 1
+
+
+class TestAdmitDecorator:
+    """Tests for shedding in front of Flask views."""
+
+    def test_returns_503_with_retry_after(self):
+        """Test that a saturated budget fails fast with 503 and Retry-After."""
+        controller = AdmissionController("test", max_in_flight=0, max_queue=0, queue_timeout=0)
+        app = Flask(__name__)
+
+        with patch.dict("server.admission.budgets", {"test": controller}):
+            @app.route("/limited")
+            @admit("test")
+            def limited():
+                return "ok"
+
+            response = app.test_client().get("/limited")
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+
+
+class TestPoolCapacity:
+    """Tests for checking the budgets against the connection pool."""
+
+    def test_default_budgets_fit_the_pool(self):
+        """Test that the default budgets together fit in the default pool."""
+        assert check_pool_capacity()
+
+    def test_budgets_over_the_pool(self, caplog):
+        """Test that budgets admitting more requests than pooled connections are reported."""
+        with patch("server.admission.DB_POOL_SIZE", 10), patch("server.admission.DB_MAX_OVERFLOW", 0):
+            assert not check_pool_capacity()
+        assert "more than the 10 pooled connections" in caplog.text
@@ -1,5 +1,8 @@
+from datetime import datetime, timezone
+from sqlalchemy import text
 from server.database import SessionLocal
 from server.models import WeatherData, BatchMetadata
+from server.utils import build_weather_data_query
 
 def test_weather_data():
     session = SessionLocal()
@@ -60,10 +63,37 @@ def test_batch_metadata_persistence():
         assert result.status == "RUNNING", "Status value mismatch."
     finally:
         session.close()
+
+
+
+def test_weather_data_query_is_index_only():
+    """Test that the /weather/data query is answered from the covering index."""
+    session = SessionLocal()
+    try:
+        # Rule out the alternatives so the test checks that the index covers the query,
+        # regardless of how small the table is.
+        session.execute(text("SET LOCAL enable_seqscan = off"))
+        session.execute(text("SET LOCAL enable_bitmapscan = off"))
+        query = build_weather_data_query(
+            12.34, 56.78,
+            start=datetime(2025, 1, 1, tzinfo=timezone.utc),
+            end=datetime(2025, 1, 2, tzinfo=timezone.utc),
+            batch_id="test_batch",
+        )
+        compiled = query.compile(dialect=session.bind.dialect)
+        plan = session.connection().exec_driver_sql(f"EXPLAIN {compiled}", compiled.params).scalars().all()
+        assert any("Index Only Scan using ix_weather_lat_lon_time" in line for line in plan), \
+            f"Weather data query is not index-only: {plan}"
+        heap_scans = [line for line in plan if "Scan" in line and "Only" not in line and " on weather_data" in line]
+        assert not heap_scans, f"Weather data query visits the heap: {heap_scans}"
+    finally:
+        session.rollback()
+        session.close()
         
         
 if __name__ == "__main__":
     test_weather_data()
     test_batch_metadata()
     test_weather_data_persistence()
-    test_batch_metadata_persistence()
\ No newline at end of file
+    test_batch_metadata_persistence()
+    test_weather_data_query_is_index_only()
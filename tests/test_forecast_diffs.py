@@ -0,0 +1,67 @@
+from collections import namedtuple
+
+import numpy as np
+
+from server.forecast_diffs import build_forecast_diffs, join_points, top_changes
+
+
+def record(latitude, longitude, temperature, precipitation_rate=0.0, humidity=50.0):
+    return {"latitude": latitude, "longitude": longitude, "temperature": temperature,
+            "precipitation_rate": precipitation_rate, "humidity": humidity}
+
+
+class TestJoinPoints:
+    """Tests for the vectorized (latitude, longitude) join."""
+
+    def test_matches_by_coordinates(self):
+        """Test that each point gets the index of the same point in the previous set, in any order."""
+        matches = join_points(
+            np.array([1.0, 1.0, 2.0, 3.0]), np.array([5.0, 6.0, 5.0, 5.0]),
+            np.array([2.0, 1.0, 1.0]), np.array([5.0, 6.0, 5.0]),
+        )
+        assert matches.tolist() == [2, 1, 0, -1]
+
+    def test_same_latitude_different_longitude(self):
+        """Test that points sharing only a latitude are not joined."""
+        matches = join_points(np.array([1.0]), np.array([5.0]), np.array([1.0]), np.array([6.0]))
+        assert matches.tolist() == [-1]
+
+
+class TestBuildForecastDiffs:
+    """Tests for building the forecast_diffs rows of a batch."""
+
+    def test_changes_of_common_points(self):
+        """Test that only points in both batches get a row, with the change of every metric."""
+        previous = [record(1.0, 5.0, 70.0, humidity=None), record(2.0, 5.0, 60.0)]
+        current = [record(2.0, 5.0, 64.5, 0.2, 45.0), record(1.0, 5.0, 68.0), record(9.0, 9.0, 10.0)]
+        rows = build_forecast_diffs("b2", "b1", current, previous)
+        assert len(rows) == 2
+        by_point = {(row["latitude"], row["longitude"]): row for row in rows}
+        assert by_point[(2.0, 5.0)]["temperature"] == 4.5
+        assert by_point[(2.0, 5.0)]["precipitation_rate"] == 0.2
+        assert by_point[(2.0, 5.0)]["humidity"] == -5.0
+        assert by_point[(1.0, 5.0)]["temperature"] == -2.0
+        assert by_point[(1.0, 5.0)]["humidity"] is None
+        assert all(row["batch_id"] == "b2" and row["previous_batch_id"] == "b1" for row in rows)
+
+    def test_repeated_point(self):
+        """Test that a point repeated in the batch gets a single row, from its first record."""
+        rows = build_forecast_diffs("b2", "b1", [record(1.0, 5.0, 71.0), record(1.0, 5.0, 90.0)], [record(1.0, 5.0, 70.0)])
+        assert [row["temperature"] for row in rows] == [1.0]
+
+    def test_empty_batches(self):
+        """Test that nothing is built without records on either side."""
+        assert build_forecast_diffs("b2", "b1", [], [record(1.0, 5.0, 70.0)]) == []
+        assert build_forecast_diffs("b2", "b1", [record(1.0, 5.0, 70.0)], []) == []
+
+
+class TestTopChanges:
+    """Tests for ranking the changes of a bbox in memory."""
+
+    def test_largest_absolute_changes_first(self):
+        """Test that the ranking is by absolute change, keeps only the limit and consumes a stream of rows."""
+        Row = namedtuple("Row", ["latitude", "longitude", "change"])
+        rows = [Row(1.0, 5.0, 2.0), Row(1.0, 6.0, -9.0), Row(2.0, 5.0, 4.5), Row(2.0, 6.0, 0.0)]
+        assert top_changes(iter(rows), 2) == [rows[1], rows[2]]
+        assert top_changes(iter(rows), 10) == [rows[1], rows[2], rows[0], rows[3]]
+        assert top_changes(iter([]), 10) == []
@@ -0,0 +1,120 @@
+import gzip
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch, Mock
+from flask import Flask, jsonify
+
+from server.http_cache import conditional, compress_response
+
+GENERATION = ("abc123", datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc))
+
+
+@pytest.fixture
+def client():
+    """Creates a minimal app with one conditional endpoint returning a large JSON body."""
+    app = Flask(__name__)
+    app.after_request(compress_response)
+    view = Mock(return_value=[{"temperature": 20.0, "humidity": 50.0}] * 200)
+
+    @app.route("/data")
+    @conditional
+    def data():
+        return jsonify(view())
+
+    @app.route("/snapshot-data")
+    @conditional(snapshots=True)
+    def snapshot_data():
+        return jsonify(view())
+
+    client = app.test_client()
+    client.view = view
+    return client
+
+
+class TestConditionalRequests:
+    """Tests for ETag/Last-Modified validation."""
+
+    def test_sets_validators(self, client):
+        """Test that a fresh response carries ETag, Last-Modified and Cache-Control."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data")
+            assert response.status_code == 200
+            assert response.headers["ETag"] == '"abc123"'
+            assert response.last_modified == GENERATION[1]
+            assert "public" in response.headers["Cache-Control"]
+
+    def test_matching_etag_returns_304_without_running_view(self, client):
+        """Test that a matching If-None-Match short-circuits before the view and echoes the tag the 200 carried."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION), \
+             patch("server.http_cache.brotli", None):
+            response = client.get("/data", headers={"If-None-Match": '"abc123-gzip"', "Accept-Encoding": "gzip"})
+            assert response.status_code == 304
+            assert response.headers["ETag"] == '"abc123-gzip"'
+            assert not client.view.called
+
+            response = client.get("/data", headers={"If-None-Match": '"abc123"'})
+            assert response.status_code == 304
+            assert response.headers["ETag"] == '"abc123"'
+
+    def test_etag_of_other_content_coding_returns_full_body(self, client):
+        """Test that a compressed variant's tag doesn't validate a request that would get another coding."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data", headers={"If-None-Match": '"abc123-gzip"'})
+            assert response.status_code == 200
+            assert response.headers["ETag"] == '"abc123"'
+
+    def test_stale_etag_returns_full_body(self, client):
+        """Test that an old generation tag gets the full response."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data", headers={"If-None-Match": '"old"'})
+            assert response.status_code == 200
+            assert client.view.called
+
+    def test_if_modified_since(self, client):
+        """Test that If-Modified-Since at the last change returns 304."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data", headers={"If-Modified-Since": "Mon, 01 Jan 2024 12:00:00 GMT", "Accept-Encoding": "gzip"})
+            assert response.status_code == 304
+            assert response.headers["ETag"] == '"abc123"'
+
+    def test_star_gets_bare_tag(self, client):
+        """Test that If-None-Match: * doesn't get a content-coding suffix the 200 may not have carried."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data", headers={"If-None-Match": "*", "Accept-Encoding": "gzip"})
+            assert response.status_code == 304
+            assert response.headers["ETag"] == '"abc123"'
+
+    def test_snapshot_views_use_manifest_generation(self, client):
+        """Test that snapshot-served views are validated against the loaded manifest, without the database."""
+        manifest_generation = ("manifest1", GENERATION[1])
+        with patch("server.http_cache.snapshots_enabled", return_value=True), \
+             patch("server.http_cache.snapshot_store.generation", return_value=manifest_generation), \
+             patch("server.http_cache.fetch_data_generation") as mock_generation:
+            assert client.get("/snapshot-data").headers["ETag"] == '"manifest1"'
+            assert not mock_generation.called
+
+    def test_snapshot_views_before_first_publish(self, client):
+        """Test that snapshot-served views use the database generation until a manifest is loaded."""
+        with patch("server.http_cache.snapshots_enabled", return_value=True), \
+             patch("server.http_cache.snapshot_store.generation", return_value=None), \
+             patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            assert client.get("/snapshot-data").headers["ETag"] == '"abc123"'
+
+
+class TestCompression:
+    """Tests for response compression."""
+
+    def test_gzip_large_body(self, client):
+        """Test that a large JSON body is gzip-compressed and its ETag marked."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION), \
+             patch("server.http_cache.brotli", None):
+            response = client.get("/data", headers={"Accept-Encoding": "gzip"})
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["ETag"] == '"abc123-gzip"'
+            assert gzip.decompress(response.data).startswith(b"[")
+
+    def test_no_compression_without_accept_encoding(self, client):
+        """Test that the body is sent as is when the client does not accept compression."""
+        with patch("server.http_cache.fetch_data_generation", return_value=GENERATION):
+            response = client.get("/data")
+            assert "Content-Encoding" not in response.headers
@@ -2,7 +2,7 @@ import pytest
 from unittest.mock import AsyncMock, patch, Mock
 
 import server.ingestion_service as ingestion_service
-from server.models import BatchMetadata, WeatherData
+from server.models import BatchMetadata, IngestTask, WeatherData, WeatherSketch
 from tests.utils import create_mock_response, create_mock_http_error
 
   
@@ -73,6 +73,14 @@ class TestDatabaseOperations:
             ingestion_service.delete_weather_data_for_non_retained_batches()
             assert mock_db_session.commit.called
             
+    def test_delete_finished_tasks(self, mock_db_session):
+        """Test that the queue tasks of removed and failed batches are deleted."""
+        with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session):
+            ingestion_service.delete_finished_tasks()
+            mock_db_session.query.assert_called_once_with(IngestTask)
+            assert mock_db_session.delete.called
+            assert mock_db_session.commit.called
+
     def test_batch_insert_weather_data(self, mock_db_session, sample_weather_records):
         """Test batch insertion of weather data."""
         with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session):
@@ -90,12 +98,77 @@ class TestBatchProcessing:
         
         with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session), \
              patch("server.ingestion_service.fetch_total_pages", AsyncMock(return_value=1)), \
-             patch("server.ingestion_service.fetch_batch_data", AsyncMock(return_value=mock_batch_data)), \
-             patch("server.ingestion_service.batch_insert_weather_data"):
+             patch("server.ingestion_service.fetch_batch_pages", AsyncMock(return_value=[mock_batch_data])), \
+             patch("server.ingestion_service.batch_insert_weather_data") as mock_insert:
             
             await ingestion_service.ingest_batch(mock_batches[0])
             assert mock_db_session.add.called
             assert mock_db_session.commit.called
+            assert len(mock_insert.call_args[0][0]) == len(mock_batch_data)
+            metadata = mock_db_session.add.call_args[0][0]
+            assert metadata.content_hash == ingestion_service.hash_batch([ingestion_service.hash_page(mock_batch_data)])
+            model, sketches = mock_db_session.bulk_insert_mappings.call_args[0]
+            assert model is WeatherSketch
+            assert len(sketches) == 2 * 3  # Two cells, three metrics
+
+    @pytest.mark.asyncio
+    async def test_ingest_batch_forecast_diffs(self, mock_db_session, mock_batches, mock_batch_data):
+        """Test that a batch is diffed against the previous active batch from its fetched records."""
+        previous = BatchMetadata(batch_id="batch0", status="ACTIVE")
+        mock_db_session.query().filter_by().first.return_value = None
+
+        with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session), \
+             patch("server.ingestion_service.fetch_total_pages", AsyncMock(return_value=1)), \
+             patch("server.ingestion_service.fetch_batch_pages", AsyncMock(return_value=[mock_batch_data])), \
+             patch("server.ingestion_service.batch_insert_weather_data"), \
+             patch("server.ingestion_service.find_previous_batch", return_value=previous), \
+             patch("server.ingestion_service.store_forecast_diffs") as mock_diffs:
+
+            await ingestion_service.ingest_batch(mock_batches[0])
+            mock_diffs.assert_called_once_with(mock_db_session, "batch1", "batch0", mock_batch_data)
+
+    @pytest.mark.asyncio
+    async def test_ingest_batch_failure_deletes_rows(self, mock_db_session, mock_batches, mock_batch_data):
+        """Test that a batch failing after its rows were inserted is marked FAILED and its rows deleted."""
+        metadata = BatchMetadata(batch_id="batch1", status="RUNNING")
+        mock_db_session.query().filter_by().first.side_effect = [None, metadata]
+
+        with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session), \
+             patch("server.ingestion_service.fetch_total_pages", AsyncMock(return_value=1)), \
+             patch("server.ingestion_service.fetch_batch_pages", AsyncMock(return_value=[mock_batch_data])), \
+             patch("server.ingestion_service.batch_insert_weather_data"), \
+             patch("server.ingestion_service.find_identical_batch", return_value=None), \
+             patch("server.ingestion_service.store_batch_sketches", side_effect=RuntimeError("boom")):
+
+            await ingestion_service.ingest_batch(mock_batches[0])
+            assert metadata.status == "FAILED"
+            assert any(call.args == (WeatherData,) for call in mock_db_session.query.call_args_list)
+            assert mock_db_session.delete.called
+
+    @pytest.mark.asyncio
+    async def test_ingest_batch_identical_content(self, mock_db_session, mock_batches, mock_batch_data):
+        """Test that a republished batch is aliased without inserting rows."""
+        original = BatchMetadata(batch_id="batch0", status="ACTIVE")
+        mock_db_session.query().filter_by().first.return_value = None
+        
+        with patch("server.ingestion_service.SessionLocal", return_value=mock_db_session), \
+             patch("server.ingestion_service.fetch_total_pages", AsyncMock(return_value=1)), \
+             patch("server.ingestion_service.fetch_batch_pages", AsyncMock(return_value=[mock_batch_data])), \
+             patch("server.ingestion_service.find_identical_batch", return_value=original), \
+             patch("server.ingestion_service.batch_insert_weather_data") as mock_insert, \
+             patch("server.ingestion_service.snapshots_enabled", return_value=True), \
+             patch("server.ingestion_service.export_snapshot") as mock_export, \
+             patch("server.ingestion_service.refresh_snapshots") as mock_refresh:
+            
+            await ingestion_service.ingest_batch(mock_batches[0])
+            metadata = mock_db_session.add.call_args[0][0]
+            assert metadata.alias_of == "batch0"
+            assert metadata.status == "ACTIVE"
+            assert not mock_insert.called
+            assert not mock_db_session.bulk_insert_mappings.called
+            # Served from the original's snapshot: republished without exporting one of its own
+            assert not mock_export.called
+            assert mock_refresh.called
             
     @pytest.mark.asyncio
     async def test_ingest_batch_duplicate(self, mock_db_session, mock_batches):
@@ -123,3 +196,31 @@ class TestBatchProcessing:
             assert mock_delete_non_retained.called
             assert mock_retain.called
 
+
+class TestDeltaIngestion:
+    """Tests for content hashing and delta computation."""
+
+    def test_hash_page_is_canonical(self, mock_batch_data):
+        """Test that key order and formatting do not change a page hash."""
+        reordered = [dict(reversed(list(record.items()))) for record in mock_batch_data]
+        assert ingestion_service.hash_page(reordered) == ingestion_service.hash_page(mock_batch_data)
+        assert ingestion_service.hash_page(mock_batch_data[:1]) != ingestion_service.hash_page(mock_batch_data)
+
+    def test_compute_delta(self, mock_batch_data):
+        """Test that only changed points are kept and unchanged pages are skipped."""
+        base_rows = [Mock(**record) for record in mock_batch_data]
+        base = BatchMetadata(batch_id="base", page_hashes=[ingestion_service.hash_page(mock_batch_data[:1]), "changed"])
+        changed = dict(mock_batch_data[1], temperature=90.0)
+
+        with patch("server.ingestion_service.fetch_batch_records", return_value=base_rows), \
+             patch("server.ingestion_service.DELTA_MAX_CHANGED_RATIO", 1.0):
+            delta = ingestion_service.compute_delta(Mock(), base, [mock_batch_data[:1], [changed]])
+            assert delta == [changed]
+
+    def test_compute_delta_new_points(self, mock_batch_data):
+        """Test that a batch with points missing from the base is stored in full."""
+        base_rows = [Mock(**mock_batch_data[0])]
+        base = BatchMetadata(batch_id="base", page_hashes=[])
+
+        with patch("server.ingestion_service.fetch_batch_records", return_value=base_rows):
+            assert ingestion_service.compute_delta(Mock(), base, [mock_batch_data[1:]]) is None
@@ -0,0 +1,187 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
+
+from server.main import create_app
+from server.snapshots import WeatherRecord, WeatherSummary
+from server.sketches import Sketch
+from server.tiles import Raster
+
+
+@pytest.fixture
+def client():
+    """Creates a test client without touching the database schema."""
+    with patch("server.http_cache.fetch_data_generation", return_value=("gen", None)):
+        yield create_app(check_schema=False).test_client()
+
+
+class TestWeatherEndpoints:
+    """Tests for the weather API routes."""
+
+    def test_weather_data(self, client):
+        """Test that records are formatted and filters are passed through."""
+        record = WeatherRecord(40.7128, -74.0060, datetime(2024, 1, 1, tzinfo=timezone.utc), 72.5, 0.0, 65.0)
+        with patch("server.main.fetch_weather_data", return_value=[record]) as mock_fetch:
+            response = client.get("/weather/data?latitude=40.7128&longitude=-74.0060&start=2024-01-01T00:00:00Z&batch_id=b1")
+            assert response.status_code == 200
+            assert response.json[0]["temperature"] == 72.5
+            kwargs = mock_fetch.call_args.kwargs
+            assert kwargs["start"] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+            assert kwargs["end"] is None
+            assert kwargs["batch_id"] == "b1"
+
+    def test_weather_data_missing_location(self, client):
+        """Test that latitude and longitude are required."""
+        response = client.get("/weather/data?latitude=40.7128")
+        assert response.status_code == 400
+
+    def test_weather_data_invalid_start(self, client):
+        """Test that a malformed start is rejected."""
+        response = client.get("/weather/data?latitude=1&longitude=2&start=yesterday")
+        assert response.status_code == 400
+
+    def test_weather_summarize(self, client):
+        """Test that the summary is formatted per metric."""
+        summary = WeatherSummary(*range(9))
+        with patch("server.main.summarize_weather_data", return_value=summary):
+            response = client.get("/weather/summarize?latitude=1&longitude=2")
+            assert response.status_code == 200
+            assert response.json["humidity"] == {"max": 6, "min": 7, "avg": 8}
+
+    def test_error_is_reported(self, client):
+        """Test that database errors are returned as 500."""
+        with patch("server.main.fetch_batches", side_effect=RuntimeError("db down")):
+            response = client.get("/batches")
+            assert response.status_code == 500
+            assert response.json == {"error": "db down"}
+
+
+class TestRasterEndpoints:
+    """Tests for the tile and bbox raster routes."""
+
+    def test_tile(self, client):
+        """Test that a tile is returned with its headers and options passed through."""
+        raster = Raster(b"png", "image/png", {"X-Batch-Id": "b1"})
+        with patch("server.main.render_tile", return_value=raster) as mock_render:
+            response = client.get("/weather/tiles/temperature/3/4/2?batch_id=b1&vmax=100")
+            assert response.status_code == 200
+            assert response.mimetype == "image/png"
+            assert response.headers["X-Batch-Id"] == "b1"
+            mock_render.assert_called_once_with("temperature", 3, 4, 2, batch_id="b1", fmt="png", vmin=-40.0, vmax=100.0)
+
+    def test_tile_invalid(self, client):
+        """Test that unknown metrics, out of range tiles and bad options are rejected."""
+        assert client.get("/weather/tiles/wind/3/4/2").status_code == 400
+        assert client.get("/weather/tiles/humidity/3/8/2").status_code == 400
+        assert client.get("/weather/tiles/humidity/3/4/2?format=jpeg").status_code == 400
+        assert client.get("/weather/tiles/humidity/3/4/2?vmin=100").status_code == 400
+
+    def test_tile_without_batch(self, client):
+        """Test that a 404 is returned without a matching active batch."""
+        with patch("server.main.render_tile", return_value=None):
+            assert client.get("/weather/tiles/humidity/0/0/0").status_code == 404
+
+    def test_raster(self, client):
+        """Test the bbox variant and its validation."""
+        raster = Raster(b"\x00" * 16, "application/octet-stream", {})
+        with patch("server.main.render_bbox", return_value=raster) as mock_render:
+            response = client.get("/weather/raster/humidity?bbox=-10,30,10,50&width=2&height=2&format=f32")
+            assert response.status_code == 200
+            assert mock_render.call_args.args == ("humidity", (-10.0, 30.0, 10.0, 50.0), 2, 2)
+        assert client.get("/weather/raster/humidity?bbox=10,30,-10,50").status_code == 400
+        assert client.get("/weather/raster/humidity?bbox=-10,30,10,50&width=5000").status_code == 400
+
+
+class TestSummaryDistributions:
+    """Tests for percentiles and histograms in /weather/summarize."""
+
+    def test_point_percentiles(self, client):
+        """Test that point percentiles are built from the rows at the point."""
+        records = [WeatherRecord(1, 2, None, t, 0.0, 50.0) for t in (60.0, 70.0, 80.0)]
+        with patch("server.utils.fetch_weather_data", return_value=records):
+            response = client.get("/weather/summarize?latitude=1&longitude=2&percentiles=10,50&histogram=true")
+            assert response.status_code == 200
+            temperature = response.json["temperature"]
+            assert temperature["percentiles"] == {"10": 62.0, "50": 70.0}
+            assert temperature["avg"] == 70.0
+            assert len(temperature["histogram"]["bins"]) == 3
+
+    def test_region(self, client):
+        """Test that a bbox summary merges the stored sketches of the region."""
+        sketches = {"humidity": Sketch.from_values("humidity", [40.0, 60.0])}
+        with patch("server.main.fetch_region_sketches", return_value=sketches) as mock_fetch:
+            response = client.get("/weather/summarize?bbox=-10,30.5,9.5,50&percentiles=50&batch_id=b1")
+            assert response.status_code == 200
+            assert response.json["humidity"]["count"] == 2
+            assert response.json["bbox"] == [-10.0, 30.0, 10.0, 51.0]
+            assert mock_fetch.call_args.args == ((-10.0, 30.5, 9.5, 50.0),)
+            assert mock_fetch.call_args.kwargs["batch_id"] == "b1"
+
+    def test_validators_in_snapshot_mode(self, client):
+        """Test that plain summaries are validated against the snapshots and sketch summaries against the database."""
+        sketches = {"humidity": Sketch.from_values("humidity", [40.0])}
+        with patch("server.http_cache.snapshots_enabled", return_value=True), \
+             patch("server.http_cache.snapshot_store.generation", return_value=("manifest", None)), \
+             patch("server.http_cache.fetch_data_generation", return_value=("database", None)), \
+             patch("server.main.summarize_weather_data", return_value=WeatherSummary(*[1.0] * 9)), \
+             patch("server.main.fetch_point_sketches", return_value=sketches):
+            assert client.get("/weather/summarize?latitude=1&longitude=2").headers["ETag"] == '"manifest"'
+            assert client.get("/weather/summarize?latitude=1&longitude=2&percentiles=50").headers["ETag"] == '"database"'
+
+    def test_invalid_percentiles(self, client):
+        """Test that percentiles outside 0-100 are rejected."""
+        assert client.get("/weather/summarize?latitude=1&longitude=2&percentiles=150").status_code == 400
+        assert client.get("/weather/summarize?latitude=1&longitude=2&percentiles=median").status_code == 400
+
+
+class TestForecastChanges:
+    """Tests for the forecast change endpoints."""
+
+    def test_point_changes(self, client):
+        """Test that the changes at a point are listed per pair of consecutive batches."""
+        row = Mock(batch_id="b2", forecast_time=datetime(2024, 1, 2), previous_batch_id="b1",
+                   previous_forecast_time=datetime(2024, 1, 1), temperature=-2.5, precipitation_rate=0.1, humidity=None)
+        with patch("server.main.fetch_point_changes", return_value=[row]) as mock_fetch:
+            response = client.get("/weather/changes?latitude=1&longitude=2")
+            assert response.status_code == 200
+            assert response.json[0]["previous_batch_id"] == "b1"
+            assert response.json[0]["changes"] == {"temperature": -2.5, "precipitation_rate": 0.1, "humidity": None}
+            assert mock_fetch.call_args.args == (1.0, 2.0)
+
+    def test_top_changes(self, client):
+        """Test that the ranking of a batch is returned with the bbox and limit passed through."""
+        rows = [Mock(latitude=1.0, longitude=2.0, change=-9.0), Mock(latitude=1.0, longitude=3.0, change=4.0)]
+        with patch("server.main.fetch_top_changes", return_value=("b2", "b1", rows)) as mock_fetch:
+            response = client.get("/weather/changes/top/temperature?bbox=0,0,10,10&limit=2")
+            assert response.status_code == 200
+            assert response.json["previous_batch_id"] == "b1"
+            assert [c["change"] for c in response.json["changes"]] == [-9.0, 4.0]
+            assert mock_fetch.call_args.args == ("temperature", (0.0, 0.0, 10.0, 10.0), 2, None)
+
+    def test_top_changes_without_previous_batch(self, client):
+        """Test that a batch without a previous active batch returns 404."""
+        with patch("server.main.fetch_top_changes", return_value=None):
+            assert client.get("/weather/changes/top/humidity?batch_id=b1").status_code == 404
+
+    def test_invalid_requests(self, client):
+        """Test that missing coordinates, unknown metrics and out of range limits are rejected."""
+        assert client.get("/weather/changes?latitude=1").status_code == 400
+        assert client.get("/weather/changes/top/wind").status_code == 400
+        assert client.get("/weather/changes/top/temperature?limit=0").status_code == 400
+        assert client.get("/weather/changes/top/temperature?bbox=1,2").status_code == 400
+
+
+class TestStatsEndpoints:
+    """Tests for the per-worker stats routes."""
+
+    def test_query_stats_disabled_by_default(self, client):
+        """Test that the raw SQL stats are not served unless enabled."""
+        assert client.get("/stats/queries").status_code == 404
+
+    def test_query_stats_enabled(self):
+        """Test that QUERY_STATS_ENDPOINT registers the query stats route."""
+        with patch("server.main.QUERY_STATS_ENDPOINT", True):
+            client = create_app(check_schema=False).test_client()
+        response = client.get("/stats/queries")
+        assert response.status_code == 200
+        assert isinstance(response.json, list)
@@ -0,0 +1,85 @@
+import pytest
+from unittest.mock import patch
+from flask import Flask, jsonify
+from sqlalchemy import create_engine, text
+
+import server.profiling as profiling
+
+
+@pytest.fixture
+def engine():
+    """Creates an instrumented in-memory SQLite engine."""
+    engine = create_engine("sqlite://")
+    profiling.instrument_engine(engine)
+    return engine
+
+
+class TestQueryInstrumentation:
+    """Tests for the SQLAlchemy engine event hooks."""
+
+    def test_records_stats_under_tag(self, engine):
+        """Test that statements are recorded under the active tag."""
+        with profiling.tagged("ingest:test"), engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+        stats = [s for s in profiling.query_stats() if s["tag"] == "ingest:test"]
+        assert len(stats) == 1
+        assert stats[0]["statement"] == "SELECT 1"
+        assert stats[0]["count"] >= 1
+
+    def test_stage_decorator(self, engine):
+        """Test that the stage decorator tags statements of the wrapped function."""
+        @profiling.stage("cleanup_test")
+        def task():
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 2"))
+
+        task()
+        assert any(s["tag"] == "ingest:cleanup_test" for s in profiling.query_stats())
+
+    def test_failed_statement_leaves_no_state(self, engine):
+        """Test that a failing statement doesn't leave a start time on the connection to skew the next one."""
+        with patch("server.profiling.SLOW_QUERY_THRESHOLD_MS", 0), engine.connect() as conn:
+            with pytest.raises(Exception):
+                conn.execute(text("SELECT * FROM missing_table"))
+            conn.execute(text("SELECT 5"))
+            assert not conn.info
+
+        stats = [s for s in profiling.query_stats() if s["statement"] == "SELECT 5"]
+        assert stats[0]["count"] == 1
+
+    def test_stats_are_bounded(self, engine):
+        """Test that only the most recently run statements are kept."""
+        with patch("server.profiling.QUERY_STATS_MAX_ENTRIES", 2), patch.dict(profiling._query_stats, clear=True), \
+             profiling.tagged("bounded"), engine.connect() as conn:
+            for statement in ("SELECT 10", "SELECT 11", "SELECT 10", "SELECT 12"):
+                conn.execute(text(statement))
+            assert {s["statement"] for s in profiling.query_stats()} == {"SELECT 10", "SELECT 12"}
+
+    def test_slow_query_logged(self, engine, caplog):
+        """Test that statements over the threshold are logged."""
+        with patch("server.profiling.SLOW_QUERY_THRESHOLD_MS", 0), engine.connect() as conn:
+            conn.execute(text("SELECT 3"))
+        assert "Slow query [untagged]" in caplog.text
+
+
+class TestServerTiming:
+    """Tests for the per-request Server-Timing header."""
+
+    def test_server_timing_header(self, engine):
+        """Test that a request reports DB, serialization and total time."""
+        app = Flask(__name__)
+        profiling.init_app(app)
+
+        @app.route("/data")
+        def data():
+            with engine.connect() as conn:
+                rows = conn.execute(text("SELECT 4")).all()
+            with profiling.timed("serialize"):
+                return jsonify([row[0] for row in rows])
+
+        response = app.test_client().get("/data")
+        header = response.headers["Server-Timing"]
+        assert 'desc="1 queries"' in header
+        assert "serialize;dur=" in header
+        assert "total;dur=" in header
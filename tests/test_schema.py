@@ -0,0 +1,47 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from server import database
+
+
+@pytest.fixture
+def engine():
+    """A mock engine whose lock connection and transaction connection can be inspected."""
+    engine = MagicMock()
+    lock_conn = engine.connect.return_value.__enter__.return_value
+    lock_conn.execution_options.return_value = lock_conn
+    engine.lock_conn = lock_conn
+    engine.conn = engine.begin.return_value.__enter__.return_value
+    return engine
+
+
+def executed(conn):
+    """The SQL text of the statements executed on a mock connection."""
+    return [str(call.args[0]) for call in conn.execute.call_args_list]
+
+
+class TestInitDb:
+    """Tests for the versioned schema setup."""
+
+    def test_leaves_newer_schema_alone(self, engine):
+        """Test that a worker with an older SCHEMA_VERSION neither migrates nor downgrades a newer schema."""
+        with patch("server.database.get_engine", return_value=engine), \
+             patch("server.database._stored_schema_version", return_value=database.SCHEMA_VERSION + 1), \
+             patch.object(database.Base.metadata, "create_all") as mock_create_all:
+            database.init_db()
+            assert not mock_create_all.called
+            assert not engine.lock_conn.execute.called
+            assert not engine.begin.called
+
+    def test_index_builds_run_outside_the_transaction(self, engine):
+        """Test that migrating a version 1 database builds the covering index concurrently, before the transaction."""
+        with patch("server.database.get_engine", return_value=engine), \
+             patch("server.database._stored_schema_version", return_value=1), \
+             patch.object(database.Base.metadata, "create_all"):
+            database.init_db()
+            engine.lock_conn.execution_options.assert_called_once_with(isolation_level="AUTOCOMMIT")
+            lock_statements = executed(engine.lock_conn)
+            assert "pg_advisory_lock" in lock_statements[0]
+            assert "pg_advisory_unlock" in lock_statements[-1]
+            assert lock_statements[1:-1] == database.SCHEMA_CONCURRENT_MIGRATIONS[2]
+            assert not any("INDEX CONCURRENTLY" in statement for statement in executed(engine.conn))
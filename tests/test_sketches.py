@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from collections import namedtuple
+
+from server.sketches import BINS, Sketch, build_batch_sketches, cell_bbox, format_sketch_summary, merge_sketches
+
+SketchRow = namedtuple("SketchRow", ["metric", "minimum", "maximum", "total", "bins"])
+
+
+@pytest.fixture
+def temperatures():
+    """Temperatures spread over the sketch range."""
+    return np.random.default_rng(0).normal(60, 15, 5000)
+
+
+class TestSketch:
+    """Tests for fixed-bin percentile sketches."""
+
+    def test_percentiles_within_a_bin(self, temperatures):
+        """Test that percentiles are accurate to one bin width, and min/max/avg are exact."""
+        sketch = Sketch.from_values("temperature", temperatures)
+        width = BINS["temperature"][1]
+        for p in (10, 50, 90):
+            assert abs(sketch.percentile(p) - np.percentile(temperatures, p)) <= width
+        assert sketch.minimum == temperatures.min()
+        assert sketch.maximum == temperatures.max()
+        assert sketch.mean() == pytest.approx(temperatures.mean())
+
+    def test_kept_values_are_exact(self):
+        """Test that sketches keeping their values return exact percentiles."""
+        sketch = Sketch.from_values("temperature", [18.0, None, 38.0], keep_values=True)
+        assert sketch.count == 2
+        assert sketch.percentile(50) == 28.0
+
+    def test_merge(self, temperatures):
+        """Test that merging sketches equals sketching all the values at once."""
+        merged = Sketch.from_values("temperature", temperatures[:1000]).merge(Sketch.from_values("temperature", temperatures[1000:]))
+        whole = Sketch.from_values("temperature", temperatures)
+        assert np.array_equal(merged.counts, whole.counts)
+        assert merged.percentile(50) == whole.percentile(50)
+
+    def test_empty(self):
+        """Test that an empty sketch has no statistics."""
+        summary = format_sketch_summary({"humidity": Sketch("humidity")}, [50], histogram=True)
+        assert summary["humidity"] == {
+            "max": None, "min": None, "avg": None, "count": 0,
+            "percentiles": {"50": None}, "histogram": {"bin_width": 0.5, "bins": []},
+        }
+
+
+class TestBatchSketches:
+    """Tests for building and merging the stored sketches of a batch."""
+
+    def test_build_per_cell(self):
+        """Test that points are grouped by cell and stored sketches merge back into the batch distribution."""
+        records = [
+            {"latitude": 40.2, "longitude": -74.5, "temperature": 70.0, "precipitation_rate": 0.0, "humidity": 60},
+            {"latitude": 40.7, "longitude": -74.1, "temperature": 72.0, "precipitation_rate": None, "humidity": 62},
+            {"latitude": 34.0, "longitude": -118.2, "temperature": 85.0, "precipitation_rate": 0.2, "humidity": 45},
+        ]
+        rows = build_batch_sketches("batch1", records)
+        temperature_rows = {(r["cell_lat"], r["cell_lon"]): r for r in rows if r["metric"] == "temperature"}
+        assert set(temperature_rows) == {(40, -75), (34, -119)}
+        assert temperature_rows[(40, -75)]["count"] == 2
+        assert temperature_rows[(40, -75)]["total"] == 142.0
+        assert len([r for r in rows if r["metric"] == "precipitation_rate"]) == 2
+
+        merged = merge_sketches(SketchRow(r["metric"], r["minimum"], r["maximum"], r["total"], r["bins"]) for r in rows)
+        assert merged["temperature"].count == 3
+        assert merged["precipitation_rate"].count == 2
+        assert np.array_equal(merged["humidity"].counts, Sketch.from_values("humidity", [60, 62, 45]).counts)
+
+    def test_batch_without_values(self):
+        """Test that a batch without values gets an empty sketch, so the backfill doesn't select it again."""
+        for records in ([], [{"latitude": 1.0, "longitude": 2.0, "temperature": None}]):
+            rows = build_batch_sketches("batch1", records)
+            assert len(rows) == 1 and rows[0]["count"] == 0
+            merged = merge_sketches(SketchRow(r["metric"], r["minimum"], r["maximum"], r["total"], r["bins"]) for r in rows)
+            assert all(sketch.count == 0 and sketch.maximum is None for sketch in merged.values())
+
+    def test_cell_bbox(self):
+        """Test that a bbox is extended to the cells its sketches are read from."""
+        assert cell_bbox((-74.5, 40.2, -74.1, 40.7)) == (-75.0, 40.0, -74.0, 41.0)
+        assert cell_bbox((-10.0, 30.0, 10.0, 50.0)) == (-10.0, 30.0, 11.0, 51.0)
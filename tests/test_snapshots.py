@@ -0,0 +1,103 @@
+import os
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from server.snapshots import SnapshotStore, export_snapshot, has_snapshot, publish_snapshots
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, mock_batch_data):
+    """Exports two batches of the sample records and publishes them."""
+    directory = str(tmp_path)
+    export_snapshot("batch1", datetime(2024, 1, 1, tzinfo=timezone.utc), mock_batch_data, directory)
+    export_snapshot("batch2", datetime(2024, 1, 2, tzinfo=timezone.utc),
+                    [dict(r, temperature=r["temperature"] + 10) for r in mock_batch_data], directory)
+    publish_snapshots(["batch1", "batch2"], directory, aliases={"republished": "batch2"})
+    return directory
+
+
+class TestSnapshotStore:
+    """Tests for serving weather data from memory-mapped snapshots."""
+
+    def test_nothing_published(self, tmp_path):
+        """Test that the store defers to the database before the first publish."""
+        store = SnapshotStore(str(tmp_path))
+        assert store.fetch(40.7128, -74.0060) is None
+        assert store.summarize(40.7128, -74.0060) is None
+
+    def test_fetch(self, snapshot_dir):
+        """Test point lookup across the published batches, ordered by forecast_time."""
+        records = SnapshotStore(snapshot_dir).fetch(40.7128, -74.0060)
+        assert [r.temperature for r in records] == [72.5, 82.5]
+        assert records[0].forecast_time == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert SnapshotStore(snapshot_dir).fetch(0.0, 0.0) == []
+
+    def test_fetch_filters(self, snapshot_dir):
+        """Test the start/end and batch_id filters."""
+        store = SnapshotStore(snapshot_dir)
+        assert len(store.fetch(40.7128, -74.0060, start=datetime(2024, 1, 2, tzinfo=timezone.utc))) == 1
+        assert len(store.fetch(40.7128, -74.0060, end=datetime(2024, 1, 1))) == 1
+        assert [r.temperature for r in store.fetch(40.7128, -74.0060, batch_id="batch2")] == [82.5]
+        assert [r.temperature for r in store.fetch(40.7128, -74.0060, batch_id="republished")] == [82.5]
+
+    def test_summarize(self, snapshot_dir):
+        """Test max/min/avg over the published batches."""
+        summary = SnapshotStore(snapshot_dir).summarize(34.0522, -118.2437)
+        assert summary.max_temperature == 95.0
+        assert summary.min_temperature == 85.0
+        assert summary.avg_temperature == 90.0
+        assert summary.avg_humidity == 45.0
+
+    def test_manifest_with_missing_snapshot(self, snapshot_dir):
+        """Test that a manifest listing a missing snapshot keeps the loaded set, or defers to the database."""
+        store = SnapshotStore(snapshot_dir)
+        assert len(store.snapshots()) == 2
+
+        publish_snapshots(["batch1", "batch2", "missing"], snapshot_dir)
+        with patch.object(store, "_load", side_effect=store._load) as mock_load:
+            assert [s.batch_id for s in store.snapshots()] == ["batch1", "batch2"]
+            assert [s.batch_id for s in store.snapshots()] == ["batch1", "batch2"]
+            assert mock_load.call_count == 1  # Retried on the next publish only
+        assert SnapshotStore(snapshot_dir).fetch(40.7128, -74.0060) is None
+
+    def test_generation(self, snapshot_dir, mock_batch_data):
+        """Test that the validator follows the loaded manifest and changes with its content."""
+        store = SnapshotStore(snapshot_dir)
+        etag, last_modified = store.generation()
+        assert last_modified.tzinfo is not None
+
+        publish_snapshots(["batch2"], snapshot_dir)
+        assert store.generation()[0] != etag
+        assert SnapshotStore(str(snapshot_dir) + "-unpublished").generation() is None
+
+    def test_publish_swaps_and_prunes(self, snapshot_dir, mock_batch_data):
+        """Test that a new manifest is picked up, even within one mtime tick, and old snapshots are pruned after a grace round."""
+        store = SnapshotStore(snapshot_dir)
+        assert len(store.snapshots()) == 2
+        manifest_path = os.path.join(snapshot_dir, "manifest.json")
+        mtime = os.stat(manifest_path).st_mtime_ns
+
+        export_snapshot("batch3", datetime(2024, 1, 3, tzinfo=timezone.utc), mock_batch_data, snapshot_dir)
+        publish_snapshots(["batch3"], snapshot_dir)
+        os.utime(manifest_path, ns=(mtime, mtime))  # Published within the same mtime tick
+        assert [s.batch_id for s in store.snapshots()] == ["batch3"]
+        assert has_snapshot("batch1", snapshot_dir)
+
+        publish_snapshots(["batch3"], snapshot_dir)
+        assert not has_snapshot("batch1", snapshot_dir)
+
+    def test_resolve(self, snapshot_dir):
+        """Test that rasters default to the latest snapshot and follow aliases."""
+        store = SnapshotStore(snapshot_dir)
+        assert store.resolve() == "batch2"
+        assert store.resolve("republished") == "batch2"
+        assert store.resolve("batch1") == "batch1"
+        assert store.resolve("retired") is None
+
+    def test_region(self, snapshot_dir):
+        """Test that a bounding box selects the points inside it."""
+        latitudes, longitudes, values = SnapshotStore(snapshot_dir).region("batch2", "temperature", (-80, 30, -70, 45))
+        assert list(latitudes) == [40.7128]
+        assert list(longitudes) == [-74.0060]
+        assert list(values) == [82.5]
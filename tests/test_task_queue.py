@@ -0,0 +1,166 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+
+import server.task_queue as task_queue
+from server.ingestion_service import hash_batch, hash_page
+from server.models import BatchMetadata, IngestTask, WeatherData
+
+
+@pytest.fixture
+def claimed_task():
+    """A task as returned by claim_task."""
+    return {"id": 1, "batch_id": "batch1", "page": 0, "forecast_time": datetime(2024, 1, 1), "attempts": 1}
+
+
+class TestTaskCompletion:
+    """Tests for storing a page and reporting its task."""
+
+    def test_complete_task(self, mock_db_session, claimed_task, mock_batch_data):
+        """Test that rows are inserted in the transaction marking the task DONE."""
+        mock_db_session.update.return_value = 1
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session):
+            assert task_queue.complete_task(claimed_task, "worker1", mock_batch_data)
+            rows = mock_db_session.bulk_insert_mappings.call_args[0][1]
+            assert [row["latitude"] for row in rows] == [r["latitude"] for r in mock_batch_data]
+            assert mock_db_session.commit.called
+
+    def test_complete_task_lost_lease(self, mock_db_session, claimed_task, mock_batch_data):
+        """Test that a worker no longer holding the task inserts nothing."""
+        mock_db_session.update.return_value = 0
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session):
+            assert not task_queue.complete_task(claimed_task, "worker1", mock_batch_data)
+            assert not mock_db_session.bulk_insert_mappings.called
+            assert not mock_db_session.commit.called
+
+    def test_release_task_out_of_attempts(self, mock_db_session, claimed_task):
+        """Test that the last failed attempt locks the batch before its task, then fails the batch."""
+        mock_db_session.update.return_value = 1
+        mock_db_session.with_for_update.return_value = mock_db_session
+        claimed_task["attempts"] = task_queue.TASK_MAX_ATTEMPTS
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session), \
+             patch("server.task_queue.fail_batch") as mock_fail:
+            task_queue.release_task(claimed_task, "worker1", RuntimeError("boom"))
+            mock_fail.assert_called_once_with(mock_db_session, "batch1")
+            models = [call.args[0] for call in mock_db_session.query.call_args_list]
+            assert models == [BatchMetadata.batch_id, IngestTask]
+
+
+class TestClaimTask:
+    """Tests for claiming tasks."""
+
+    def test_expired_task_out_of_attempts_fails_batch(self, mock_db_session):
+        """Test that a dead worker's last attempt fails the batch, locking the batch before the task again."""
+        expired = IngestTask(id=1, batch_id="batch1", status="RUNNING", attempts=task_queue.TASK_MAX_ATTEMPTS)
+        mock_db_session.with_for_update.return_value = mock_db_session
+        mock_db_session.first.side_effect = [expired, ("batch1",), expired, None]
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session), \
+             patch("server.task_queue.fail_batch") as mock_fail:
+            assert task_queue.claim_task("worker1") is None
+            mock_fail.assert_called_once_with(mock_db_session, "batch1")
+            assert expired.status == "FAILED"
+            models = [call.args[0] for call in mock_db_session.query.call_args_list]
+            assert models == [IngestTask, BatchMetadata.batch_id, IngestTask, IngestTask]
+
+
+class TestFailBatch:
+    """Tests for failing a batch."""
+
+    def test_fail_batch_deletes_stored_pages(self, mock_db_session):
+        """Test that running tasks are failed before the stored pages are deleted."""
+        task_queue.fail_batch(mock_db_session, "batch1")
+        models = [call.args[0] for call in mock_db_session.query.call_args_list]
+        assert models == [BatchMetadata, IngestTask, WeatherData]
+        assert mock_db_session.delete.called
+
+
+class TestFinalizeBatch:
+    """Tests for activating a batch once all its pages are stored."""
+
+    def test_finalize_when_all_pages_done(self, mock_db_session, mock_batch_data):
+        """Test that the batch is activated with its hashes and row count."""
+        metadata = BatchMetadata(batch_id="batch1", status="RUNNING")
+        page_hash = hash_page(mock_batch_data)
+        tasks = [IngestTask(page=page, status="DONE", page_hash=page_hash, number_of_rows=2) for page in range(2)]
+        mock_db_session.with_for_update.return_value = mock_db_session
+        mock_db_session.first.return_value = metadata
+        mock_db_session.all.return_value = tasks
+
+        previous = BatchMetadata(batch_id="batch0", status="ACTIVE")
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session), \
+             patch("server.task_queue.store_batch_sketches") as mock_sketches, \
+             patch("server.task_queue.find_previous_batch", return_value=previous), \
+             patch("server.task_queue.store_forecast_diffs") as mock_diffs:
+            assert task_queue.finalize_batch("batch1")
+            mock_sketches.assert_called_once_with(mock_db_session, "batch1")
+            mock_diffs.assert_called_once_with(mock_db_session, "batch1", "batch0")
+            assert metadata.status == "ACTIVE"
+            assert metadata.number_of_rows == 4
+            assert metadata.content_hash == hash_batch([page_hash, page_hash])
+
+    def test_not_finalized_with_pending_pages(self, mock_db_session):
+        """Test that a batch with unfinished pages stays RUNNING."""
+        metadata = BatchMetadata(batch_id="batch1", status="RUNNING")
+        tasks = [IngestTask(page=0, status="DONE"), IngestTask(page=1, status="RUNNING")]
+        mock_db_session.with_for_update.return_value = mock_db_session
+        mock_db_session.first.return_value = metadata
+        mock_db_session.all.return_value = tasks
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session):
+            assert not task_queue.finalize_batch("batch1")
+            assert metadata.status == "RUNNING"
+
+
+    def test_sweep_finalizes_stalled_batches(self, mock_db_session):
+        """Test that the planner finalizes batches whose pages are all stored, despite a failing one."""
+        mock_db_session.all.return_value = [BatchMetadata(batch_id="batch1"), BatchMetadata(batch_id="batch2")]
+
+        with patch("server.task_queue.SessionLocal", return_value=mock_db_session), \
+             patch("server.task_queue.finalize_batch", side_effect=[RuntimeError("boom"), True]) as mock_finalize:
+            assert task_queue.finalize_stalled_batches() == 1
+            assert [call.args[0] for call in mock_finalize.call_args_list] == ["batch1", "batch2"]
+
+
+class TestRunTask:
+    """Tests for running a claimed task."""
+
+    @pytest.mark.asyncio
+    async def test_last_page_finalizes_without_publishing(self, claimed_task, mock_batch_data):
+        """Test that a worker finalizing a batch leaves snapshot publishing to the planner."""
+        with patch("server.task_queue.Heartbeat"), \
+             patch("server.task_queue.fetch_batch_page", return_value=mock_batch_data), \
+             patch("server.task_queue.complete_task", return_value=True), \
+             patch("server.task_queue.finalize_batch", return_value=True) as mock_finalize, \
+             patch("server.task_queue.refresh_snapshots") as mock_refresh:
+            await task_queue.run_task(claimed_task, "worker1")
+            mock_finalize.assert_called_once_with("batch1")
+            assert not mock_refresh.called
+
+    @pytest.mark.asyncio
+    async def test_finalize_error_is_logged(self, claimed_task, mock_batch_data, caplog):
+        """Test that a failing finalize is logged and left to the planner's sweep."""
+        with patch("server.task_queue.Heartbeat"), \
+             patch("server.task_queue.fetch_batch_page", return_value=mock_batch_data), \
+             patch("server.task_queue.complete_task", return_value=True), \
+             patch("server.task_queue.finalize_batch", side_effect=RuntimeError("boom")):
+            await task_queue.run_task(claimed_task, "worker1")
+            assert "Error finalizing batch batch1" in caplog.text
+
+
+class TestRunWorker:
+    """Tests for the worker loop."""
+
+    @pytest.mark.asyncio
+    async def test_claim_error_keeps_polling(self, claimed_task):
+        """Test that a database error while claiming is logged and the worker keeps polling."""
+        with patch("server.task_queue.claim_task", side_effect=[RuntimeError("connection lost"), claimed_task, None]), \
+             patch("server.task_queue.asyncio.sleep") as mock_sleep, \
+             patch("server.task_queue.run_task") as mock_run:
+            await task_queue.run_worker("worker1", drain=True)
+            mock_sleep.assert_called_once_with(task_queue.TASK_POLL_INTERVAL_SECONDS)
+            mock_run.assert_called_once_with(claimed_task, "worker1")
@@ -0,0 +1,146 @@
+import struct
+import zlib
+import numpy as np
+import pytest
+from unittest.mock import patch
+
+from server import tiles
+
+
+@pytest.fixture
+def grid_points():
+    """A 5 x 5 grid of points one degree apart, valued latitude * 10 + longitude."""
+    latitudes = np.repeat(np.arange(30.0, 35.0), 5)
+    longitudes = np.tile(np.arange(-5.0, 0.0), 5)
+    return latitudes, longitudes, latitudes * 10 + longitudes
+
+
+def region_of(grid_points):
+    """A fetch_region stand-in returning the grid points inside the requested bbox, like the database."""
+    def fetch(batch_id, metric, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        latitudes, longitudes, values = grid_points
+        inside = (latitudes >= min_lat) & (latitudes <= max_lat) & (longitudes >= min_lon) & (longitudes <= max_lon)
+        return latitudes[inside], longitudes[inside], values[inside]
+    return fetch
+
+
+def decode_png(data):
+    """Decode the gray + alpha PNGs written by encode_png, checking every chunk CRC."""
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks, offset = {}, 8
+    while offset < len(data):
+        length, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + length]
+        assert struct.unpack(">I", data[offset + 8 + length:offset + 12 + length])[0] == zlib.crc32(kind + body)
+        chunks[kind] = body
+        offset += 12 + length
+    width, height, depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+    assert (depth, color_type) == (8, 4)
+    scanlines = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(height, width * 2 + 1)
+    assert not scanlines[:, 0].any()
+    return scanlines[:, 1:].reshape(height, width, 2)
+
+
+class TestRasterize:
+    """Tests for nearest-grid rasterization."""
+
+    def test_pixels_finer_than_grid(self, grid_points):
+        """Test that pixels take the nearest grid value and pixels off the grid are empty."""
+        pixel_latitudes, pixel_longitudes = tiles.bbox_pixel_centers((-5.25, 29.75, -0.75, 35.75), 9, 12)
+        raster = tiles.rasterize(*grid_points, pixel_latitudes, pixel_longitudes)
+        assert raster.shape == (12, 9)
+        assert np.isnan(raster[:2]).all()  # 35.5 and 35.0, more than half a step above the grid
+        assert raster[2].tolist() == [335, 335, 336, 336, 337, 337, 338, 338, 339]
+        assert raster[-1, -1] == 299
+        assert not np.isnan(raster[2:]).any()
+
+    def test_pixels_coarser_than_grid(self, grid_points):
+        """Test that coarse pixels sample the grid without leaving holes."""
+        pixel_latitudes, pixel_longitudes = tiles.bbox_pixel_centers((-5, 30, -1, 34), 2, 2)
+        raster = tiles.rasterize(*grid_points, pixel_latitudes, pixel_longitudes)
+        assert raster.tolist() == [[326, 328], [306, 308]]
+
+    def test_empty_region(self):
+        """Test that a region without points is fully transparent."""
+        raster = tiles.rasterize(np.empty(0), np.empty(0), np.empty(0), *tiles.bbox_pixel_centers((0, 0, 1, 1), 4, 4))
+        assert np.isnan(raster).all()
+
+    def test_tile_bbox(self):
+        """Test Web Mercator tile bounds."""
+        assert tiles.tile_bbox(0, 0, 0) == pytest.approx((-180, -85.0511287798, 180, 85.0511287798))
+        assert tiles.tile_bbox(1, 1, 0) == pytest.approx((0, 0, 180, 85.0511287798))
+
+
+class TestEncoding:
+    """Tests for raster encodings."""
+
+    def test_png(self):
+        """Test that values are scaled to gray levels and missing pixels are transparent."""
+        raster = np.array([[0.0, 50.0], [100.0, np.nan]], dtype=np.float32)
+        pixels = decode_png(tiles.encode_png(raster, 0, 100))
+        assert pixels[..., 0].tolist() == [[0, 128], [255, 0]]
+        assert pixels[..., 1].tolist() == [[255, 255], [255, 0]]
+
+    def test_f32(self):
+        """Test the raw float32 encoding and its headers."""
+        raster = np.array([[1.5, np.nan]], dtype=np.float32)
+        encoded = tiles.encode_raster(raster, (0, 0, 1, 1), "batch1", "f32", 0, 1)
+        assert encoded.mimetype == "application/octet-stream"
+        assert encoded.headers["X-Raster-Size"] == "2,1"
+        values = np.frombuffer(encoded.body, dtype="<f4")
+        assert values[0] == 1.5 and np.isnan(values[1])
+
+
+class TestRenderTile:
+    """Tests for rendering and caching tiles."""
+
+    def test_tile_is_cached_per_batch(self, grid_points):
+        """Test that a tile is fetched once per batch and served from the cache afterwards."""
+        tiles._render_tile.cache_clear()
+        with patch("server.tiles.resolve_raster_batch", side_effect=["batch1", "batch1", "batch2"]), \
+             patch("server.tiles.fetch_region", return_value=grid_points) as mock_fetch:
+            first = tiles.render_tile("temperature", 6, 31, 25)
+            assert tiles.render_tile("temperature", 6, 31, 25) is first
+            assert mock_fetch.call_count == 1
+            tiles.render_tile("temperature", 6, 31, 25)
+            assert mock_fetch.call_count == 2
+            assert first.headers["X-Value-Range"] == "-40.0,120.0"
+        tiles._render_tile.cache_clear()
+
+    def test_tile_smaller_than_grid_cell(self, grid_points):
+        """Test that a region between grid lines is filled from the points around it."""
+        pixel_latitudes, pixel_longitudes = tiles.bbox_pixel_centers((-3.4, 31.3, -3.2, 31.5), 4, 4)
+        with patch("server.tiles.fetch_region", side_effect=region_of(grid_points)):
+            raster = tiles.render_raster("batch1", "temperature", (-3.4, 31.3, -3.2, 31.5),
+                                         pixel_latitudes, pixel_longitudes, "f32", 0, 1)
+        values = np.frombuffer(raster.body, dtype="<f4")
+        assert (values == 307).all()
+
+    def test_edges_between_grid_lines(self, grid_points):
+        """Test that pixels near the edges take grid points outside the bbox, leaving no seams."""
+        bbox = (-4.9, 30.1, -1.1, 33.9)
+        pixel_latitudes, pixel_longitudes = tiles.bbox_pixel_centers(bbox, 19, 19)
+        with patch("server.tiles.fetch_region", side_effect=region_of(grid_points)):
+            raster = tiles.render_raster("batch1", "temperature", bbox, pixel_latitudes, pixel_longitudes, "f32", 0, 1)
+        values = np.frombuffer(raster.body, dtype="<f4").reshape(19, 19)
+        assert not np.isnan(values).any()
+        assert values[0, 0] == 335 and values[-1, -1] == 299
+
+    def test_padding_follows_grid_step(self, grid_points):
+        """Test that the fetch is padded by the batch's measured grid step, refetching when the assumed step was too small."""
+        bbox = (-3.4, 31.3, -3.2, 31.5)
+        pixel_latitudes, pixel_longitudes = tiles.bbox_pixel_centers(bbox, 4, 4)
+        with patch.dict(tiles._grid_steps, clear=True), patch("server.tiles.RASTER_GRID_STEP", 0.5), \
+             patch("server.tiles.fetch_region", side_effect=region_of(grid_points)) as mock_fetch:
+            for _ in range(2):
+                raster = tiles.render_raster("batch1", "temperature", bbox, pixel_latitudes, pixel_longitudes, "f32", 0, 1)
+                assert (np.frombuffer(raster.body, dtype="<f4") == 307).all()
+            fetched = [call.args[2] for call in mock_fetch.call_args_list]
+            assert fetched == pytest.approx([(-3.9, 30.8, -2.7, 32.0)] + [(-4.4, 30.3, -2.2, 32.5)] * 2)
+            assert tiles._grid_steps == {"batch1": 1.0}
+
+    def test_no_active_batch(self):
+        """Test that nothing is rendered without an active batch."""
+        with patch("server.tiles.resolve_raster_batch", return_value=None):
+            assert tiles.render_tile("humidity", 0, 0, 0) is None